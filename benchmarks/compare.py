@@ -0,0 +1,56 @@
+"""Compare two load.py result files, e.g. from two commits.
+
+Prints throughput and latency percentiles per scenario, concurrency level and
+route, with the change from the first file to the second:
+
+    python benchmarks/compare.py benchmarks/results/load-abc1234-*.json benchmarks/results/load-def5678-*.json
+"""
+import argparse
+import json
+
+
+def index(report):
+    rows = {}
+    for scenario in report["scenarios"]:
+        for level in scenario["levels"]:
+            key = (scenario["history"], scenario["ledger"], level["concurrency"])
+            rows[key + ("*",)] = dict(level["overall"], throughput_rps=level["throughput_rps"])
+            for op, stats in level["routes"].items():
+                if stats["count"]:
+                    rows[key + (op,)] = stats
+    return rows
+
+
+def change(old, new):
+    if old is None or new is None:
+        return ""
+    if not old:
+        return "    n/a"
+    return f"{(new - old) / old * 100:+7.1f}%"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument("--metrics", nargs="+", default=["throughput_rps", "p50_ms", "p99_ms"])
+    args = parser.parse_args()
+
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    print(f"{before.get('commit')} -> {after.get('commit')}")
+    old, new = index(before), index(after)
+    print(f"{'history':>8} {'ledger':>7} {'conc':>5} {'route':<10} " +
+          " ".join(f"{m:>26}" for m in args.metrics))
+    for key in sorted(old.keys() & new.keys(), key=lambda k: (k[0], k[1], k[2], k[3] != "*", k[3])):
+        cells = []
+        for m in args.metrics:
+            a, b = old[key].get(m), new[key].get(m)
+            cells.append(f"{'' if a is None else a:>8} {'' if b is None else b:>8} {change(a, b):>8}")
+        print(f"{key[0]:>8} {key[1]:>7} {key[2]:>5} {key[3]:<10} " + " ".join(f"{c:>26}" for c in cells))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,318 @@
+"""Mixed read/write load test of the Flask endpoints against seeded state.
+
+Each scenario (history size x ledger size) runs in a fresh process so peak
+RSS and import-time configuration are its own. Requests go through the Flask
+test client by default, or over HTTP to a local gunicorn started per scenario.
+Results are written as JSON for comparing commits (see compare.py). Run from
+the repo root:
+
+    python benchmarks/load.py --history 1000 100000 1000000 --ledger 100 10000 \\
+        --concurrency 1 4 16 --requests 2000
+    python benchmarks/load.py --gunicorn 2 --history 100000
+"""
+import argparse
+import datetime
+import gzip
+import http.client
+import json
+import os
+import platform
+import random
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import urlencode
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+DEFAULT_MIX = "status=5,delta=30,history=15,analytics=10,alert=30,ussd=10"
+STATUSES = (("Natural", [0.9, 0.05, 0.05]), ("Unnatural", [0.1, 0.8, 0.1]), ("Human Sound", [0.1, 0.1, 0.8]))
+
+
+def seeded_app():
+    # Imports kiota configured for the scenario in BENCH_* and fills it with
+    # BENCH_HISTORY events and BENCH_LEDGER community reports. Also the
+    # gunicorn entry point: gunicorn 'load:seeded_app()'.
+    history, ledger = int(os.environ["BENCH_HISTORY"]), int(os.environ["BENCH_LEDGER"])
+    rng = random.Random(int(os.environ.get("BENCH_SEED", 1)))
+    import kiota
+
+    nodes = [n["id"] for n in kiota.NODE_LOCATIONS]
+    ts = time.time() - history * 0.5 - ledger * 0.5
+    chunk = []
+
+    def flush():
+        with kiota.state_lock:
+            kiota.state_backend.append(chunk)
+        chunk.clear()
+
+    for i in range(history):
+        status, probs = STATUSES[0 if rng.random() < 0.7 else rng.randrange(1, 3)]
+        chunk.append({"k": "event", "node": rng.choice(nodes), "ts": ts, "status": status, "probs": probs, "fire": False})
+        ts += 0.5
+        if len(chunk) == 50000:
+            flush()
+    for i in range(ledger):
+        chunk.append({"k": "report", "node": rng.choice(nodes), "ts": ts, "issue": "Logging", "reporter": f"seed{i % 997}"})
+        ts += 0.5
+        if len(chunk) == 50000:
+            flush()
+    flush()
+    return kiota.app
+
+
+def make_request(op, i, rng, state):
+    # (method, path, body, content type) for one operation of the mix.
+    node = rng.randrange(15)
+    if op == "status":
+        return "GET", "/status", None, None
+    if op == "delta":
+        return "GET", f"/status?since={state['cursor']}", None, None
+    if op == "history":
+        return "GET", f"/history?node_id={node}&limit=100", None, None
+    if op == "analytics":
+        return "GET", "/analytics?window=5m", None, None
+    if op == "timeseries":
+        return "GET", f"/timeseries?node_id={node}&from={time.time() - 86400}&points=200", None, None
+    if op == "incidents":
+        return "GET", "/incidents", None, None
+    if op == "alert":
+        status, probs = STATUSES[rng.randrange(3)]
+        body = json.dumps({"node_id": node, "class": status, "probs": probs, "fire": rng.random() < 0.01})
+        return "POST", "/alert", body.encode(), "application/json"
+    if op == "ussd":
+        body = urlencode({"text": f"{rng.randrange(1, 4)}*{node}", "phoneNumber": f"+2547{i:08d}", "sessionId": f"bench-{i}"})
+        return "POST", "/ussd", body.encode(), "application/x-www-form-urlencoded"
+    raise ValueError(f"unknown op {op!r}")
+
+
+class TestClientTransport:
+    def __init__(self, app, headers):
+        self.client = app.test_client()
+        self.headers = headers
+
+    def send(self, method, path, body, content_type):
+        headers = dict(self.headers)
+        if content_type:
+            headers["Content-Type"] = content_type
+        response = self.client.open(path, method=method, data=body, headers=headers)
+        return response.status_code, response.get_data()
+
+
+class HttpTransport:
+    def __init__(self, port, headers):
+        self.conn = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+        self.headers = headers
+
+    def send(self, method, path, body, content_type):
+        headers = dict(self.headers)
+        if content_type:
+            headers["Content-Type"] = content_type
+        self.conn.request(method, path, body=body, headers=headers)
+        response = self.conn.getresponse()
+        return response.status, response.read()
+
+
+def percentile(values, q):
+    # Nearest-rank percentile of a sorted list.
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(q / 100.0 * len(values) + 0.5)) - 1))]
+
+
+def run_level(make_transport, mix, concurrency, total, seed, cursor):
+    ops = [op for op, weight in mix for _ in range(weight)]
+    samples = {op: [] for op, _ in mix}    # op -> [(seconds, bytes, status)]
+    counter = iter(range(total))
+    lock = threading.Lock()
+
+    def worker(k):
+        rng = random.Random(seed * 1000 + k)
+        transport = make_transport()
+        state = {"cursor": cursor}
+        local = []
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                break
+            op = rng.choice(ops)
+            method, path, body, content_type = make_request(op, i, rng, state)
+            start = time.perf_counter()
+            status, data = transport.send(method, path, body, content_type)
+            local.append((op, time.perf_counter() - start, len(data), status))
+            if op == "delta" and status == 200:
+                state["cursor"] = json.loads(gzip.decompress(data) if data[:2] == b"\x1f\x8b" else data)["seq"]
+        with lock:
+            for op, seconds, size, status in local:
+                samples[op].append((seconds, size, status))
+
+    threads = [threading.Thread(target=worker, args=(k,)) for k in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    def summarize(rows):
+        latencies = sorted(r[0] for r in rows)
+        codes = {}
+        for _, _, status in rows:
+            codes[str(status)] = codes.get(str(status), 0) + 1
+        return {
+            "count": len(rows),
+            "p50_ms": round(percentile(latencies, 50) * 1e3, 3) if rows else None,
+            "p95_ms": round(percentile(latencies, 95) * 1e3, 3) if rows else None,
+            "p99_ms": round(percentile(latencies, 99) * 1e3, 3) if rows else None,
+            "bytes_mean": round(sum(r[1] for r in rows) / len(rows), 1) if rows else None,
+            "bytes_total": sum(r[1] for r in rows),
+            "status": codes,
+        }
+
+    every = [row for rows in samples.values() for row in rows]
+    return {
+        "concurrency": concurrency,
+        "requests": len(every),
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(len(every) / elapsed, 1),
+        "overall": summarize(every),
+        "routes": {op: summarize(rows) for op, rows in samples.items()},
+    }
+
+
+def wait_for_port(port, proc, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with {proc.returncode}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("gunicorn did not start in time")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def run_scenario(args):
+    # Runs in its own process; BENCH_* and KIOTA_* are already in the environment.
+    mix = [(op, int(weight)) for op, weight in (item.split("=") for item in args.mix.split(","))]
+    headers = {"Accept-Encoding": "gzip"} if args.gzip else {}
+    result = {"history": int(os.environ["BENCH_HISTORY"]), "ledger": int(os.environ["BENCH_LEDGER"]), "levels": []}
+    start = time.perf_counter()
+    if args.gunicorn:
+        port = free_port()
+        proc = subprocess.Popen([sys.executable, "-m", "gunicorn", "--chdir", os.path.dirname(os.path.abspath(__file__)),
+                                 "-w", str(args.gunicorn), "--threads", str(max(args.concurrency)), "-b", f"127.0.0.1:{port}",
+                                 "--log-level", "warning", "load:seeded_app()"])
+        try:
+            wait_for_port(port, proc, args.startup_timeout)
+            result["seed_seconds"] = round(time.perf_counter() - start, 3)
+            probe = HttpTransport(port, {})
+            events = json.loads(probe.send("GET", "/history?limit=1", None, None)[1])["events"]
+            cursor = events[-1]["seq"] if events else 0
+            for level in args.concurrency:
+                result["levels"].append(run_level(lambda: HttpTransport(port, headers), mix, level, args.requests, args.seed, cursor))
+        finally:
+            proc.send_signal(signal.SIGTERM)
+            proc.wait()
+        # Largest of gunicorn's master and workers, all reaped by now.
+        result["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)
+    else:
+        app = seeded_app()
+        import kiota
+        result["seed_seconds"] = round(time.perf_counter() - start, 3)
+        for level in args.concurrency:
+            result["levels"].append(run_level(lambda: TestClientTransport(app, headers), mix, level, args.requests,
+                                              args.seed, kiota.state_seq))
+            if kiota.ingest_queue is not None:
+                kiota.ingest_queue.join()
+        result["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--history", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--ledger", type=int, nargs="+", default=[100])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=2000, help="requests per concurrency level")
+    parser.add_argument("--mix", default=DEFAULT_MIX,
+                        help="op=weight list; ops: status delta history analytics timeseries incidents alert ussd")
+    parser.add_argument("--gzip", action="store_true", help="send Accept-Encoding: gzip")
+    parser.add_argument("--gunicorn", type=int, default=0, metavar="WORKERS", help="serve over HTTP from gunicorn")
+    parser.add_argument("--startup-timeout", type=float, default=600)
+    parser.add_argument("--coalesce", type=float, default=0,
+                        help="KIOTA_COALESCE_SECONDS; 0 keeps one history row per seeded event")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="result file (default benchmarks/results/load-<commit>-<time>.json)")
+    parser.add_argument("--scenario", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scenario:
+        json.dump(run_scenario(args), sys.stdout)
+        return
+
+    commit = git_commit()
+    report = {
+        "benchmark": "load",
+        "commit": commit,
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "args": {k: v for k, v in vars(args).items() if k not in ("scenario", "out")},
+        "scenarios": [],
+    }
+    for history in args.history:
+        for ledger in args.ledger:
+            env = dict(os.environ, BENCH_HISTORY=str(history), BENCH_LEDGER=str(ledger), BENCH_SEED=str(args.seed),
+                       KIOTA_HISTORY_CAPACITY=str(max(history + ledger + args.requests * len(args.concurrency), 1000)),
+                       KIOTA_COALESCE_SECONDS=str(args.coalesce), KIOTA_STATE_BACKEND="memory")
+            for name in ("KIOTA_DATA_DIR", "KIOTA_DEMO_DATA"):
+                env.pop(name, None)
+            proc = subprocess.run([sys.executable, os.path.abspath(__file__), *sys.argv[1:], "--scenario", "1"],
+                                  env=env, capture_output=True, text=True)
+            if proc.returncode != 0:
+                sys.stderr.write(proc.stderr)
+                raise SystemExit(f"scenario history={history} ledger={ledger} failed")
+            scenario = json.loads(proc.stdout)
+            report["scenarios"].append(scenario)
+            print(f"history={history} ledger={ledger} seed={scenario['seed_seconds']}s peak_rss={scenario['peak_rss_mb']}MB")
+            for level in scenario["levels"]:
+                o = level["overall"]
+                print(f"  c={level['concurrency']:<3} {level['throughput_rps']:>9.1f} req/s  p50={o['p50_ms']}ms "
+                      f"p95={o['p95_ms']}ms p99={o['p99_ms']}ms")
+                for op, r in level["routes"].items():
+                    if r["count"]:
+                        print(f"      {op:<10} n={r['count']:<6} p50={r['p50_ms']}ms p99={r['p99_ms']}ms "
+                              f"bytes={r['bytes_mean']} status={r['status']}")
+
+    out = args.out or os.path.join(ROOT, "benchmarks", "results",
+                                   f"load-{commit or 'nogit'}-{datetime.datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"wrote {out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""Micro-benchmarks of the hot paths behind the endpoints.
+
+Times Blockchain.hash, node lookup (the spatial index behind /alert and the
+proximity queries behind fire flags), and /status serialization and
+compression as history grows. The store is filled once up to the largest
+size and measured at each size on the way. Run from the repo root:
+
+    python benchmarks/micro.py --history 1000 10000 100000 1000000
+"""
+import argparse
+import datetime
+import gzip
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+
+def bench(fn, number, repeat):
+    # Best of `repeat` runs, in microseconds per call.
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        best = min(best, time.perf_counter() - start)
+    return round(best / number * 1e6, 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--history", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="result file (default benchmarks/results/micro-<commit>-<time>.json)")
+    args = parser.parse_args()
+
+    os.environ["KIOTA_HISTORY_CAPACITY"] = str(max(max(args.history), 1000))
+    os.environ["KIOTA_COALESCE_SECONDS"] = "0"
+    for name in ("KIOTA_DATA_DIR", "KIOTA_DEMO_DATA"):
+        os.environ.pop(name, None)
+    import kiota
+
+    rng = random.Random(args.seed)
+    results = {}
+
+    # Blockchain.hash on a single-report block and on a 64-report Merkle batch.
+    ledger = kiota.Blockchain(genesis_ts=0)
+    report = {"issue": "Logging", "loc": "Buyangu Hill", "lat": 0.35, "lng": 34.86, "reporter": "ab12cd34",
+              "ts": 1.0, "report_id": "0123456789abcdef"}
+    single = ledger.create_block(100, ledger.last_hash(), report, seq=1, ts=1.0)
+    batch = ledger.create_block(100, ledger.last_hash(), {"reports": [report] * 64}, seq=2, ts=2.0)
+    results["blockchain_hash_us"] = {
+        "single": bench(lambda: ledger.hash(single), 20000, args.repeat),
+        "batch64": bench(lambda: ledger.hash(batch), 2000, args.repeat),
+    }
+
+    # Node lookup: alert coordinates to node, then neighbours within the fire radius or the 8 nearest.
+    lookups = {}
+    for n in (15, 1000, 4000):
+        index = kiota.SpatialIndex(kiota.MATCH_TOLERANCE_M)
+        engine = kiota.ProximityEngine()
+        points = [(0.28 + rng.uniform(-0.25, 0.25), 34.86 + rng.uniform(-0.25, 0.25)) for _ in range(n)]
+        for i, (lat, lng) in enumerate(points):
+            index.insert(i, lat, lng)
+            engine.insert(i, lat, lng)
+        probes = [points[rng.randrange(n)] for _ in range(1000)]
+        ids = [rng.randrange(n) for _ in range(1000)]
+        it = iter(range(10 ** 9))
+        lookups[str(n)] = {
+            "nearest_us": bench(lambda: index.nearest(*probes[next(it) % 1000], kiota.MATCH_TOLERANCE_M), 5000, args.repeat),
+            "radius_us": bench(lambda: engine.select(engine.row(ids[next(it) % 1000]), radius_m=kiota.FIRE_RADIUS_M), 5000,
+                               args.repeat),
+            "knn8_us": bench(lambda: engine.select(engine.row(ids[next(it) % 1000]), k=8), 5000, args.repeat),
+        }
+    results["node_lookup"] = lookups
+
+    # /status serialization as history grows.
+    serialization = {}
+    filled, ts = 0, time.time() - max(args.history)
+    for size in sorted(args.history):
+        records = []
+        for _ in range(size - filled):
+            records.append({"k": "event", "node": rng.randrange(15), "ts": ts, "status": "Natural",
+                            "probs": [0.9, 0.05, 0.05], "fire": False})
+            ts += 1.0
+        with kiota.state_lock:
+            kiota.state_backend.append(records)
+            filled = size
+            payload = kiota.status_payload()
+            body = kiota.serialize(payload, "json")
+            number = max(1, 20000 // size)
+            serialization[str(size)] = {
+                "payload_ms": round(bench(kiota.status_payload, number, args.repeat) / 1e3, 3),
+                "json_ms": round(bench(lambda: kiota.serialize(payload, "json"), number, args.repeat) / 1e3, 3),
+                "gzip_ms": round(bench(lambda: gzip.compress(body, compresslevel=6), number, args.repeat) / 1e3, 3),
+                "delta_us": bench(lambda: kiota.status_payload(kiota.state_seq - 10), 1000, args.repeat),
+                "json_bytes": len(body),
+                "gzip_bytes": len(gzip.compress(body, compresslevel=6)),
+            }
+            if kiota.msgpack is not None:
+                serialization[str(size)]["msgpack_ms"] = round(
+                    bench(lambda: kiota.serialize(payload, "msgpack"), number, args.repeat) / 1e3, 3)
+                serialization[str(size)]["msgpack_bytes"] = len(kiota.serialize(payload, "msgpack"))
+        print(f"history={size}: {serialization[str(size)]}")
+    results["status_serialization"] = serialization
+    print(json.dumps({k: v for k, v in results.items() if k != "status_serialization"}, indent=2))
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    report = {
+        "benchmark": "micro",
+        "commit": commit,
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "args": {k: v for k, v in vars(args).items() if k != "out"},
+        "results": results,
+    }
+    out = args.out or os.path.join(ROOT, "benchmarks", "results",
+                                   f"micro-{commit or 'nogit'}-{datetime.datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"wrote {out}")
+
+
+if __name__ == "__main__":
+    main()
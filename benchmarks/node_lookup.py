@@ -0,0 +1,62 @@
+"""Per-alert node lookup cost as the sensor count grows.
+
+Compares the grid SpatialIndex used by /alert against the linear scan it
+replaced. Run from the repo root:
+
+    python benchmarks/node_lookup.py --sizes 15 1000 10000 100000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from kiota import MATCH_TOLERANCE_M, SpatialIndex  # noqa: E402
+
+
+def make_nodes(n, rng):
+    # Sensors spread over a ~50 km square around Kakamega Forest.
+    return [(i, 0.28 + rng.uniform(-0.25, 0.25), 34.86 + rng.uniform(-0.25, 0.25)) for i in range(n)]
+
+
+def bench(fn, queries, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for q in queries:
+            fn(q)
+        best = min(best, time.perf_counter() - start)
+    return best / len(queries) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[15, 100, 1000, 10000, 100000])
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    print(f"{'nodes':>8} {'grid us/alert':>14} {'linear us/alert':>16}")
+    for n in args.sizes:
+        rng = random.Random(args.seed)
+        nodes = make_nodes(n, rng)
+        index = SpatialIndex(MATCH_TOLERANCE_M)
+        for node_id, lat, lng in nodes:
+            index.insert(node_id, lat, lng)
+        # Alerts report their node's position with a few metres of GPS jitter.
+        jitter = 10 / 111320.0
+        queries = [(lat + rng.uniform(-jitter, jitter), lng + rng.uniform(-jitter, jitter))
+                   for _, lat, lng in (rng.choice(nodes) for _ in range(args.queries))]
+        exact = [(lat, lng) for _, lat, lng in (rng.choice(nodes) for _ in range(args.queries))]
+
+        grid = bench(lambda q: index.nearest(q[0], q[1], MATCH_TOLERANCE_M), queries, args.repeat)
+        linear = bench(lambda q: next((i for i, lat, lng in nodes if lat == q[0] and lng == q[1]), None),
+                       exact[:max(10, args.queries * 1000 // max(n, 1))], 1)
+        print(f"{n:>8} {grid:>14.2f} {linear:>16.2f}")
+
+
+if __name__ == "__main__":
+    main()
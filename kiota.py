@@ -1,44 +1,571 @@
 import hashlib
 import json
-from flask import Flask, request, render_template_string, jsonify
+from flask import Flask, request, render_template_string, jsonify, Response, stream_with_context, g
+import codecs
 import datetime
+import fcntl
+import gzip
+import hmac
+import math
+import os
+import mmap
+import multiprocessing
 import random
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import numpy as np
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 app = Flask(__name__)
 
+# --- METRICS ---
+# Per-route request counts, latency histograms, byte counters and error counts,
+# kept per process and exposed with state gauges at /metrics in Prometheus text
+# format. Routes are labelled by their URL rule, so ids in paths do not blow up
+# the label set. The hooks are registered before every other after_request
+# handler, so they run last and see the final, compressed response.
+#
+# With KIOTA_PROFILE_SLOW_MS set, a sampler thread records the stack of every
+# in-flight request each KIOTA_PROFILE_INTERVAL_MS, and requests slower than the
+# threshold have their samples written to KIOTA_PROFILE_DIR as folded stacks
+# (one "frame;frame;frame count" line each) for flamegraph.pl or speedscope.
+# The sampler sees OS threads only, not gevent greenlets.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Clients pick the method, so anything else is counted as "other" to keep the
+# number of series bounded.
+METRIC_METHODS = frozenset(("GET", "HEAD", "POST", "PUT", "DELETE", "PATCH", "OPTIONS"))
+PROFILE_SLOW_MS = float(os.environ.get("KIOTA_PROFILE_SLOW_MS", 0))
+PROFILE_INTERVAL = float(os.environ.get("KIOTA_PROFILE_INTERVAL_MS", 5)) / 1000
+PROFILE_DIR = os.environ.get("KIOTA_PROFILE_DIR", "kiota_profiles")
+
+class RouteStats:
+    __slots__ = ("buckets", "count", "seconds", "request_bytes", "response_bytes", "errors", "statuses")
+
+    def __init__(self):
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.seconds = 0.0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.errors = 0
+        self.statuses = {}
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = {}    # (route, method) -> RouteStats
+
+    def observe(self, route, method, status, seconds, request_bytes, response_bytes):
+        k = bisect_left(LATENCY_BUCKETS, seconds)
+        with self.lock:
+            stats = self.routes.get((route, method))
+            if stats is None:
+                stats = self.routes[(route, method)] = RouteStats()
+            if k < len(LATENCY_BUCKETS):
+                stats.buckets[k] += 1
+            stats.count += 1
+            stats.seconds += seconds
+            stats.request_bytes += request_bytes
+            stats.response_bytes += response_bytes
+            stats.statuses[status] = stats.statuses.get(status, 0) + 1
+            if status >= 500:
+                stats.errors += 1
+
+    def render(self):
+        # Request metrics in Prometheus text format.
+        with self.lock:
+            routes = [(key, stats, list(stats.buckets), dict(stats.statuses)) for key, stats in sorted(self.routes.items())]
+        out = [
+            "# HELP kiota_http_request_duration_seconds Request latency by route.",
+            "# TYPE kiota_http_request_duration_seconds histogram",
+        ]
+        for (route, method), stats, buckets, _ in routes:
+            labels = f'route="{prom_escape(route)}",method="{method}"'
+            total = 0
+            for le, n in zip(LATENCY_BUCKETS, buckets):
+                total += n
+                out.append(f'kiota_http_request_duration_seconds_bucket{{{labels},le="{le}"}} {total}')
+            out.append(f'kiota_http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {stats.count}')
+            out.append(f"kiota_http_request_duration_seconds_sum{{{labels}}} {stats.seconds!r}")
+            out.append(f"kiota_http_request_duration_seconds_count{{{labels}}} {stats.count}")
+        out += ["# HELP kiota_http_requests_total Requests by route and status.", "# TYPE kiota_http_requests_total counter"]
+        for (route, method), _, _, statuses in routes:
+            for status, n in sorted(statuses.items()):
+                out.append(f'kiota_http_requests_total{{route="{prom_escape(route)}",method="{method}",status="{status}"}} {n}')
+        for name, attr, text in (("request_bytes", "request_bytes", "Request body bytes."),
+                                 ("response_bytes", "response_bytes", "Response body bytes as sent."),
+                                 ("errors", "errors", "Responses with a 5xx status.")):
+            out += [f"# HELP kiota_http_{name}_total {text}", f"# TYPE kiota_http_{name}_total counter"]
+            for (route, method), stats, _, _ in routes:
+                out.append(f'kiota_http_{name}_total{{route="{prom_escape(route)}",method="{method}"}} {getattr(stats, attr)}')
+        return out
+
+def prom_escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class SlowRequestProfiler:
+    def __init__(self, threshold_ms, interval, directory):
+        self.threshold = threshold_ms / 1000
+        self.interval = interval
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.active = {}    # thread id -> {folded stack: samples}
+        self.wake = threading.Event()
+        self.pid = None
+
+    def start(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                # Threads do not survive fork; each worker runs its own sampler.
+                self.pid = os.getpid()
+                threading.Thread(target=self._run, daemon=True).start()
+            self.active[threading.get_ident()] = {}
+        self.wake.set()
+
+    def _run(self):
+        while True:
+            self.wake.wait()
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self.lock:
+                if not self.active:
+                    self.wake.clear()
+                    continue
+                for ident, samples in self.active.items():
+                    frame = frames.get(ident)
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                        frame = frame.f_back
+                    if stack:
+                        folded = ";".join(reversed(stack))
+                        samples[folded] = samples.get(folded, 0) + 1
+
+    def finish(self, route, seconds):
+        with self.lock:
+            samples = self.active.pop(threading.get_ident(), None)
+        if not samples or seconds < self.threshold:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        name = "".join(c if c.isalnum() else "_" for c in route).strip("_") or "root"
+        path = os.path.join(self.directory, f"{name}-{int(time.time() * 1000)}-{os.getpid()}.folded")
+        with open(path, 'w') as f:
+            for folded, n in samples.items():
+                f.write(f"{folded} {n}\n")
+
+metrics = Metrics()
+profiler = SlowRequestProfiler(PROFILE_SLOW_MS, PROFILE_INTERVAL, PROFILE_DIR) if PROFILE_SLOW_MS > 0 else None
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+    if profiler:
+        profiler.start()
+
+@app.after_request
+def record_metrics(response):
+    seconds = time.perf_counter() - g.get('request_start', time.perf_counter())
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    if profiler:
+        profiler.finish(route, seconds)
+    # Streams (/stream) are never buffered just to be measured.
+    sent = response.content_length or (response.calculate_content_length() if response.is_sequence else 0) or 0
+    method = request.method if request.method in METRIC_METHODS else "other"
+    metrics.observe(route, method, response.status_code, seconds, request.content_length or 0, sent)
+    return response
+
 # --- DISABLE CACHING ---
+# Views that version their body with an ETag set their own Cache-Control.
 @app.after_request
 def add_header(response):
-    response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, post-check=0, pre-check=0, max-age=0'
-    response.headers['Pragma'] = 'no-cache'
-    response.headers['Expires'] = '-1'
+    if 'Cache-Control' not in response.headers:
+        response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, post-check=0, pre-check=0, max-age=0'
+        response.headers['Pragma'] = 'no-cache'
+        response.headers['Expires'] = '-1'
+    return response
+
+# --- RESPONSE ENCODING ---
+# Field sites sit on metered links, so bodies are compressed (brotli when the
+# optional package is installed, else gzip) and versioned bodies are encoded
+# once per version and served from a small cache. Clients that already hold the
+# current version get a bodyless 304.
+COMPRESS_MIN_BYTES = int(os.environ.get("KIOTA_COMPRESS_MIN_BYTES", 1024))
+BODY_CACHE_SIZE = int(os.environ.get("KIOTA_BODY_CACHE_SIZE", 64))
+BODY_CACHE_BYTES = int(os.environ.get("KIOTA_BODY_CACHE_BYTES", 64 * 1024 * 1024))
+COMPRESSIBLE = ('application/json', 'application/msgpack', 'text/html', 'text/plain')
+MSGPACK_TYPES = ('application/msgpack', 'application/x-msgpack')
+
+class BodyCache:
+    # LRU bounded by entry count and total bytes. A full /status dump grows
+    # with history, so one body bigger than a quarter of the budget is not kept.
+    def __init__(self, maxsize, maxbytes):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            body = self.items.get(key)
+            if body is not None:
+                self.items.move_to_end(key)
+            return body
+
+    def put(self, key, body):
+        if len(body) * 4 > self.maxbytes:
+            return
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old)
+            self.items[key] = body
+            self.bytes += len(body)
+            while len(self.items) > self.maxsize or self.bytes > self.maxbytes:
+                self.bytes -= len(self.items.popitem(last=False)[1])
+
+body_cache = BodyCache(BODY_CACHE_SIZE, BODY_CACHE_BYTES)
+
+def pick_encoding():
+    offered = ['br', 'gzip'] if brotli else ['gzip']
+    return request.accept_encodings.best_match(offered)
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=5)
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=6)
+    return body
+
+def pick_format():
+    # 'json', 'msgpack', or None when msgpack is asked for but not installed.
+    wanted = request.args.get('format')
+    if wanted is None:
+        wanted = 'msgpack' if request.accept_mimetypes.best_match(['application/json', *MSGPACK_TYPES]) in MSGPACK_TYPES else 'json'
+    if wanted == 'msgpack':
+        return 'msgpack' if msgpack else None
+    return 'json'
+
+def serialize(payload, fmt):
+    if fmt == 'msgpack':
+        return msgpack.packb(payload)
+    return json.dumps(payload, separators=(",", ":")).encode()
+
+def versioned_response(tag, body, mimetype, cache_control):
+    # `body` is the uncompressed bytes for version `tag`, or None when the
+    # caller found the client already holds it.
+    if body is None or request.if_none_match.contains(tag):
+        response = Response(status=304)
+    else:
+        encoding = pick_encoding() if len(body) >= COMPRESS_MIN_BYTES else None
+        if encoding:
+            key = (tag, encoding)
+            encoded = body_cache.get(key)
+            if encoded is None:
+                encoded = compress(body, encoding)
+                body_cache.put(key, encoded)
+            body = encoded
+        response = Response(body, mimetype=mimetype)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(tag)
+    response.headers['Cache-Control'] = cache_control
+    response.headers['Vary'] = 'Accept-Encoding, Accept'
+    return response
+
+@app.after_request
+def compress_response(response):
+    # Everything else that is big enough gets compressed on the way out.
+    if (response.status_code != 200 or response.is_streamed or response.direct_passthrough
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE):
+        return response
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_BYTES:
+        return response
+    encoding = pick_encoding()
+    if encoding:
+        response.set_data(compress(body, encoding))
+        response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
     return response
 
 # --- 1. BLOCKCHAIN LEDGER ---
+# Each block's hash is computed once, when the block is created, and cached in
+# `hashes`. Community reports are either one block each or, with
+# KIOTA_LEDGER_BATCH_SIZE > 1, gathered into batches. A block's hash covers
+# only its header, which carries the Merkle root of its reports, so a single
+# report can be proven with O(log n) hashes plus the header. Blocks from
+# before headers have no top-level merkle_root and hash whole.
+LEDGER_BATCH_SIZE = int(os.environ.get("KIOTA_LEDGER_BATCH_SIZE", 1))
+LEDGER_BATCH_SECONDS = float(os.environ.get("KIOTA_LEDGER_BATCH_SECONDS", 30))
+LEDGER_VERIFY_WORKERS = int(os.environ.get("KIOTA_LEDGER_VERIFY_WORKERS", os.cpu_count() or 1))
+LEDGER_VERIFY_PARALLEL_MIN = int(os.environ.get("KIOTA_LEDGER_VERIFY_PARALLEL_MIN", 20000))
+
+BLOCK_HEADER = ("index", "seq", "timestamp", "proof", "previous_hash", "merkle_root")
+
+def block_header(block):
+    return {key: block[key] for key in BLOCK_HEADER}
+
+def block_hash(block):
+    if "merkle_root" in block:
+        block = block_header(block)
+    encoded_block = json.dumps(block, sort_keys=True).encode()
+    return hashlib.sha256(encoded_block).hexdigest()
+
+def merkle_leaf(report):
+    # Leaves and inner nodes are hashed with distinct prefixes so one can't pose as the other.
+    return hashlib.sha256(b"\x00" + json.dumps(report, sort_keys=True).encode()).hexdigest()
+
+def merkle_parent(left, right):
+    return hashlib.sha256(b"\x01" + bytes.fromhex(left) + bytes.fromhex(right)).hexdigest()
+
+def merkle_levels(leaves):
+    # All tree levels, leaves first. An odd node out is promoted unchanged.
+    levels = [leaves]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        parents = [merkle_parent(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            parents.append(level[-1])
+        levels.append(parents)
+    return levels
+
+def merkle_proof(levels, pos):
+    # Sibling hashes from leaf to root; `side` says where the sibling goes.
+    path = []
+    for level in levels[:-1]:
+        sibling = pos ^ 1
+        if sibling < len(level):
+            path.append({"hash": level[sibling], "side": "left" if sibling < pos else "right"})
+        pos //= 2
+    return path
+
+def block_root(data):
+    # Merkle root of a block's reports; a block without reports (genesis) commits to its data as one leaf.
+    reports = block_reports({"data": data})
+    return merkle_levels([merkle_leaf(r) for r in reports] or [merkle_leaf(data)])[-1][0]
+
+def block_reports(block):
+    data = block['data']
+    if isinstance(data, dict):
+        if "reports" in data:
+            return data["reports"]
+        if "report_id" in data:
+            return [data]
+    return []
+
+def check_ledger_range(chain, hashes, lo, hi, limit=10):
+    # Re-hashes chain[lo:hi] from scratch and checks that each block sits at the
+    # right index, links to the recomputed hash of its predecessor, matches its
+    # cached hash and, for batched blocks, carries the right Merkle root.
+    # Returns (errors, hash of chain[hi - 1]).
+    errors = []
+    prev_hash = block_hash(chain[lo - 1]) if lo > 0 else None
+    for i in range(lo, hi):
+        block = chain[i]
+        if block.get('index') != i + 1:
+            errors.append({"index": i + 1, "error": f"block has index {block.get('index')}"})
+        if block.get('previous_hash') != ('0' if i == 0 else prev_hash):
+            errors.append({"index": i + 1, "error": "previous_hash does not match the preceding block"})
+        data = block.get('data')
+        if "merkle_root" in block:
+            if block_root(data) != block["merkle_root"]:
+                errors.append({"index": i + 1, "error": "merkle_root does not match the block data"})
+        elif isinstance(data, dict) and "merkle_root" in data:
+            if merkle_levels([merkle_leaf(r) for r in data["reports"]])[-1][0] != data["merkle_root"]:
+                errors.append({"index": i + 1, "error": "merkle_root does not match the reports"})
+        prev_hash = block_hash(block)
+        if hashes is not None and i < len(hashes) and hashes[i] != prev_hash:
+            errors.append({"index": i + 1, "error": "cached hash is stale"})
+        if len(errors) >= limit:
+            break
+    return errors[:limit], prev_hash
+
+# Forked verifier processes read the chain from here instead of having it pickled to them.
+_verify_target = None
+
+def _check_forked_range(bounds):
+    chain, hashes = _verify_target
+    return check_ledger_range(chain, hashes, *bounds)
+
+class BlockList:
+    # A chain restored from disk. Blocks stay raw JSON until first read, so a
+    # restart does not parse the whole ledger before it can serve requests.
+    def __init__(self, raw):
+        self.items = raw    # bytes of a block not read yet, else the block
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[k] for k in range(*i.indices(len(self.items)))]
+        block = self.items[i]
+        if isinstance(block, bytes):
+            block = self.items[i] = json.loads(block)
+        return block
+
+    def __iter__(self):
+        for i in range(len(self.items)):
+            yield self[i]
+
+    def append(self, block):
+        self.items.append(block)
+
 class Blockchain:
-    def __init__(self):
+    def __init__(self, genesis_ts=None):
         self.chain = []
-        self.create_block(proof=1, previous_hash='0', data="Genesis Block")
+        self.hashes = []
+        self.pending = []           # reports waiting for the next batched block
+        self.report_index = {}      # report_id -> (chain position, leaf position)
+        self.create_block(proof=1, previous_hash='0', data="Genesis Block", ts=genesis_ts)
 
-    def create_block(self, proof, previous_hash, data):
+    def create_block(self, proof, previous_hash, data, seq=0, ts=None):
+        when = datetime.datetime.now() if ts is None else datetime.datetime.fromtimestamp(ts)
         block = {
             'index': len(self.chain) + 1,
-            'timestamp': str(datetime.datetime.now()),
+            'seq': seq,
+            'timestamp': str(when),
             'proof': proof,
             'previous_hash': previous_hash,
+            'merkle_root': block_root(data),
             'data': data
         }
         self.chain.append(block)
+        self.hashes.append(self.hash(block))
+        if self.report_index is not None:
+            self._index_block(len(self.chain) - 1)
         return block
 
     def get_previous_block(self):
         return self.chain[-1]
 
+    def last_hash(self):
+        return self.hashes[-1]
+
     def hash(self, block):
-        encoded_block = json.dumps(block, sort_keys=True).encode()
-        return hashlib.sha256(encoded_block).hexdigest()
+        return block_hash(block)
 
-community_ledger = Blockchain()
+    def verify(self, start=0, stop=None, workers=LEDGER_VERIFY_WORKERS):
+        # Checks blocks [start, stop); block start - 1 is trusted (e.g. covered by
+        # a checkpoint). Long ranges are split across a forked process pool that
+        # inherits the chain, so nothing but range bounds crosses the pipe.
+        global _verify_target
+        stop = len(self.chain) if stop is None else stop
+        checked = max(stop - start, 0)
+        if checked == 0:
+            return {"ok": True, "checked": 0, "errors": [], "last_hash": self.hashes[stop - 1] if stop else None}
+        fork = "fork" in multiprocessing.get_all_start_methods()
+        if checked < LEDGER_VERIFY_PARALLEL_MIN or workers <= 1 or not fork:
+            errors, last_hash = check_ledger_range(self.chain, self.hashes, start, stop)
+        else:
+            step = -(-checked // (workers * 4))
+            bounds = [(lo, min(lo + step, stop)) for lo in range(start, stop, step)]
+            _verify_target = (self.chain, self.hashes)
+            try:
+                with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("fork")) as pool:
+                    parts = list(pool.map(_check_forked_range, bounds))
+            finally:
+                _verify_target = None
+            errors = [e for part_errors, _ in parts for e in part_errors][:10]
+            last_hash = parts[-1][1]
+        return {"ok": not errors, "checked": checked, "errors": errors, "last_hash": last_hash}
+
+    def load(self, chain, hashes=None, pending=()):
+        self.chain = chain
+        self.hashes = hashes if hashes is not None else [self.hash(b) for b in chain]
+        self.pending = list(pending)
+        # Rebuilt on the first proof request rather than slowing down restarts.
+        self.report_index = None
+
+    def _index_block(self, i):
+        for pos, report in enumerate(block_reports(self.chain[i])):
+            self.report_index[report["report_id"]] = (i, pos)
+
+    def proof(self, report_id):
+        # Inclusion proof for a sealed report, or None if it is not on the chain.
+        if self.report_index is None:
+            self.report_index = {}
+            for i in range(len(self.chain)):
+                self._index_block(i)
+        loc = self.report_index.get(report_id)
+        if loc is None:
+            return None
+        i, pos = loc
+        reports = block_reports(self.chain[i])
+        levels = merkle_levels([merkle_leaf(r) for r in reports])
+        block = self.chain[i]
+        result = {
+            "report_id": report_id,
+            "report": reports[pos],
+            "leaf": levels[0][pos],
+            "proof": merkle_proof(levels, pos),
+            "merkle_root": levels[-1][0],
+            "block_index": block['index'],
+            "block_hash": self.hashes[i],
+        }
+        if "merkle_root" in block:
+            result["block_header"] = block_header(block)
+        return result
+
+class LedgerCheckpoints:
+    # HMAC-signed record of the last height that verified clean, so the next
+    # verification only re-checks newer blocks. Signed with KIOTA_LEDGER_KEY;
+    # without one a per-process key is used and checkpoints do not outlive it.
+    def __init__(self, key, path=None):
+        self.key = key.encode() if key else os.urandom(32)
+        self.path = path
+        self.lock = threading.Lock()    # one verification at a time
+        self.latest = None
+        if path and os.path.exists(path):
+            with open(path) as f:
+                checkpoint = json.load(f)
+            if self.valid(checkpoint):
+                self.latest = checkpoint
+
+    def sign(self, height, block_hash):
+        return hmac.new(self.key, f"{height}:{block_hash}".encode(), hashlib.sha256).hexdigest()
+
+    def valid(self, checkpoint):
+        expected = self.sign(checkpoint.get("height"), checkpoint.get("hash"))
+        return hmac.compare_digest(str(checkpoint.get("signature")), expected)
+
+    def record(self, height, block_hash):
+        checkpoint = {"height": height, "hash": block_hash, "verified_at": str(datetime.datetime.now()),
+                      "signature": self.sign(height, block_hash)}
+        if self.path:
+            with open(self.path + ".tmp", 'w') as f:
+                json.dump(checkpoint, f)
+            os.replace(self.path + ".tmp", self.path)
+        self.latest = checkpoint
+        return checkpoint
+
+    def clear(self):
+        # A failed verification: the first bad block may sit below the
+        # checkpoint, so nothing is trusted until the chain verifies again.
+        if self.path:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+        self.latest = None
 
 # --- 2. CONFIGURATION (Kakamega Forest) ---
 NODE_LOCATIONS = [
@@ -59,87 +586,1934 @@ NODE_LOCATIONS = [
     {"id": 14, "lat": 0.3000, "lng": 34.8500, "name": "Colobus Trail Inner"},
 ]
 
+# --- SPATIAL INDEX ---
+# Uniform lat/lng grid of node locations. A lookup visits only the cells within
+# the match tolerance, so resolving an alert to a node costs the same with 15
+# sensors or 15,000, and slightly-off GPS fixes still land on their node.
+MATCH_TOLERANCE_M = float(os.environ.get("KIOTA_MATCH_TOLERANCE_M", 50))
+EARTH_RADIUS_M = 6371008.8
+METRES_PER_DEG = 111320.0
+
+def haversine_m(lat1, lng1, lat2, lng2):
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    a = math.sin((p2 - p1) / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(math.radians(lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+def valid_location(lat, lng):
+    return math.isfinite(lat) and math.isfinite(lng) and -90 <= lat <= 90 and -180 <= lng <= 180
+
+class SpatialIndex:
+    def __init__(self, cell_m):
+        self.cell_deg = cell_m / METRES_PER_DEG
+        self.cells = {}
+        self.points = {}
+
+    def __len__(self):
+        return len(self.points)
+
+    def _cell(self, lat, lng):
+        return (math.floor(lat / self.cell_deg), math.floor(lng / self.cell_deg))
+
+    def insert(self, node_id, lat, lng):
+        self.remove(node_id)
+        self.points[node_id] = (lat, lng)
+        self.cells.setdefault(self._cell(lat, lng), []).append(node_id)
+
+    def remove(self, node_id):
+        point = self.points.pop(node_id, None)
+        if point is not None:
+            cell = self._cell(*point)
+            self.cells[cell].remove(node_id)
+            if not self.cells[cell]:
+                del self.cells[cell]
+
+    def nearest(self, lat, lng, tolerance_m):
+        # Returns (node_id, distance in metres) of the closest node within
+        # tolerance_m, or None. Longitude degrees shrink away from the equator,
+        # so the lng search span widens by 1/cos(lat).
+        reach = tolerance_m / METRES_PER_DEG
+        d_lat = math.ceil(reach / self.cell_deg)
+        d_lng = math.ceil(reach / max(math.cos(math.radians(lat)), 1e-6) / self.cell_deg)
+        c_lat, c_lng = self._cell(lat, lng)
+        best = None
+        for i in range(c_lat - d_lat, c_lat + d_lat + 1):
+            for j in range(c_lng - d_lng, c_lng + d_lng + 1):
+                for node_id in self.cells.get((i, j), ()):
+                    dist = haversine_m(lat, lng, *self.points[node_id])
+                    if dist <= tolerance_m and (best is None or dist < best[1]):
+                        best = (node_id, dist)
+        return best
+
+# --- PROXIMITY ---
+# Node-to-node haversine distances in a dense NumPy matrix. It grows by
+# doubling and only the added or moved node's row and column are recomputed,
+# so radius and k-nearest queries around a node are one vectorised scan of its
+# row. float32 keeps 2,000 nodes in 16 MB at sub-metre precision.
+FIRE_RADIUS_M = float(os.environ.get("KIOTA_FIRE_RADIUS_M", 3000))
+INCIDENT_RADIUS_M = float(os.environ.get("KIOTA_INCIDENT_RADIUS_M", 4000))
+INCIDENT_WINDOW = float(os.environ.get("KIOTA_INCIDENT_WINDOW", 1800))
+INCIDENT_GAP = float(os.environ.get("KIOTA_INCIDENT_GAP", 300))
+
+def haversine_row(lat, lng, lats, lngs):
+    # Metres from one point to arrays of points, all in radians.
+    a = np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((lngs - lng) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+class ProximityEngine:
+    def __init__(self, capacity=64):
+        self.n = 0
+        self.slots = {}    # node id -> row
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.lat = np.zeros(capacity)
+        self.lng = np.zeros(capacity)
+        self.dist = np.zeros((capacity, capacity), dtype=np.float32)
+
+    def __len__(self):
+        return self.n
+
+    def _grow(self):
+        n, capacity = self.n, 2 * len(self.ids)
+        for name in ("ids", "lat", "lng"):
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:n] = old[:n]
+            setattr(self, name, new)
+        dist = np.zeros((capacity, capacity), dtype=np.float32)
+        dist[:n, :n] = self.dist[:n, :n]
+        self.dist = dist
+
+    def insert(self, node_id, lat, lng):
+        slot = self.slots.get(node_id)
+        if slot is None:
+            if self.n == len(self.ids):
+                self._grow()
+            slot = self.slots[node_id] = self.n
+            self.ids[slot] = node_id
+            self.n += 1
+        self.lat[slot], self.lng[slot] = math.radians(lat), math.radians(lng)
+        row = haversine_row(self.lat[slot], self.lng[slot], self.lat[:self.n], self.lng[:self.n])
+        row[slot] = 0.0
+        self.dist[slot, :self.n] = row
+        self.dist[:self.n, slot] = row
+
+    def row(self, node_id):
+        return self.dist[self.slots[node_id], :self.n]
+
+    def point_row(self, lat, lng):
+        return haversine_row(math.radians(lat), math.radians(lng), self.lat[:self.n], self.lng[:self.n])
+
+    def select(self, row, radius_m=None, k=None, exclude=None):
+        # (ids, metres) of the nodes in `row` within radius_m and/or the k
+        # nearest of them, nearest first. `exclude` is a node id to leave out.
+        hits = np.arange(self.n) if radius_m is None else np.flatnonzero(row <= radius_m)
+        if exclude is not None:
+            hits = hits[hits != self.slots[exclude]]
+        if k is not None:
+            if k <= 0:
+                hits = hits[:0]
+            elif k < len(hits):
+                hits = hits[np.argpartition(row[hits], k - 1)[:k]]
+        hits = hits[np.argsort(row[hits], kind='stable')]
+        return self.ids[hits], row[hits]
+
+    def slots_of(self, node_ids):
+        # Rows of `dist` for the given node ids.
+        return np.array([self.slots[i] for i in node_ids], dtype=np.int64)
+
+# --- LIVE EVENT STREAM ---
+# /stream pushes node updates, history events and ledger blocks as Server-Sent
+# Events. Each subscriber has a bounded buffer; one that falls STREAM_BUFFER
+# messages behind is dropped and told to resync rather than slowing writers.
+# Waiting uses threading primitives, so gunicorn's gevent worker (which patches
+# them) serves many streams per process; under threaded workers each stream holds
+# a thread, so STREAM_MAX_SECONDS ends it periodically and EventSource reconnects.
+STREAM_BUFFER = int(os.environ.get("KIOTA_STREAM_BUFFER", 256))
+STREAM_HEARTBEAT = float(os.environ.get("KIOTA_STREAM_HEARTBEAT", 15))
+STREAM_MAX_SECONDS = float(os.environ.get("KIOTA_STREAM_MAX_SECONDS", 300))
+# The sync frame a stream opens with carries only the newest rows and blocks;
+# the dashboard keeps this many (HISTORY_KEEP) and pages older ones from /history.
+STREAM_SYNC_KEEP = int(os.environ.get("KIOTA_STREAM_SYNC_KEEP", 500))
+
+class Subscriber:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.buffer = deque()
+        self.cond = threading.Condition()
+        self.dropped = False
+
+    def push(self, message):
+        with self.cond:
+            if self.dropped:
+                return
+            if len(self.buffer) >= self.maxsize:
+                self.buffer.clear()
+                self.dropped = True
+            else:
+                self.buffer.append(message)
+            self.cond.notify()
+
+    def pop_all(self, timeout):
+        with self.cond:
+            if not self.buffer and not self.dropped:
+                self.cond.wait(timeout)
+            messages = list(self.buffer)
+            self.buffer.clear()
+            return messages, self.dropped
+
+class EventHub:
+    def __init__(self, buffer_size):
+        self.buffer_size = buffer_size
+        self.lock = threading.Lock()
+        self.subscribers = set()
+
+    def subscribe(self):
+        sub = Subscriber(self.buffer_size)
+        with self.lock:
+            self.subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            self.subscribers.discard(sub)
+
+    def publish(self, kind, payload):
+        with self.lock:
+            if not self.subscribers:
+                return
+            subs = list(self.subscribers)
+        # Serialize once and share the frame across every subscriber.
+        message = sse_frame(kind, payload, payload.get("seq_last", payload.get("seq")))
+        for sub in subs:
+            sub.push(message)
+            if sub.dropped:
+                self.unsubscribe(sub)
+
+def sse_frame(kind, payload, seq=None):
+    head = f"id: {seq}\n" if seq is not None else ""
+    return f"{head}event: {kind}\ndata: {json.dumps(payload)}\n\n"
+
+event_hub = EventHub(STREAM_BUFFER)
+
+# --- EVENT STORE ---
+# Fixed-capacity ring buffer of history events kept in parallel typed columns
+# (~114 bytes per row instead of a dict, a time string and a probs list).
+# Every append gets an absolute row number; its slot is row % capacity, so the
+# oldest row is simply overwritten. Events are appended in seq and timestamp
+# order, so both columns can be bisected. A per-node list of rows lets node
+# and time-range queries cost O(log n + rows returned).
+#
+# A row is a run: repeats of a node's latest status within COALESCE_SECONDS of
+# the run's first sample are folded into it (count, last ts and seq, and
+# min/mean/max probs) instead of taking a new row. A status change, any fire
+# flag and every community report start a new row, so history grows with state
+# changes rather than with the sensors' sample rate. `seq` and `ts` are the
+# run's first sample, which keeps both columns sorted. KIOTA_COALESCE_SECONDS=0
+# gives one row per sample.
+HISTORY_CAPACITY = int(os.environ.get("KIOTA_HISTORY_CAPACITY", 100000))
+HISTORY_QUERY_LIMIT = int(os.environ.get("KIOTA_HISTORY_QUERY_LIMIT", 1000))
+COALESCE_SECONDS = float(os.environ.get("KIOTA_COALESCE_SECONDS", 60))
+
+def clock_str(ts):
+    return datetime.datetime.fromtimestamp(ts).strftime("%H:%M:%S")
+
+class NodeIndex:
+    # Rows of one node, oldest first. Evictions advance `head` and the dead
+    # prefix is trimmed once it makes up half the array.
+    __slots__ = ("rows", "head")
+
+    def __init__(self):
+        self.rows = array('q')
+        self.head = 0
+
+    def __len__(self):
+        return len(self.rows) - self.head
+
+    def __getitem__(self, k):
+        return self.rows[self.head + k]
+
+    def append(self, row):
+        self.rows.append(row)
+
+    def popleft(self):
+        self.head += 1
+        if self.head >= 1024 and self.head * 2 >= len(self.rows):
+            del self.rows[:self.head]
+            self.head = 0
+
+# Where a run column comes from when loading a snapshot that predates it.
+RUN_DEFAULTS = { "ts_last": "ts", "seq_last": "seq", "lo0": "p0", "lo1": "p1", "lo2": "p2", "hi0": "p0", "hi1": "p1", "hi2": "p2" }
+
+class EventStore:
+    COLUMNS = ("seq", "node_id", "ts", "status", "p0", "p1", "p2", "fire",
+               "samples", "ts_last", "seq_last", "lo0", "lo1", "lo2", "hi0", "hi1", "hi2")
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.seq = array('q', bytes(8 * capacity))
+        self.node_id = array('i', bytes(4 * capacity))
+        self.ts = array('d', bytes(8 * capacity))
+        self.status = array('B', bytes(capacity))
+        self.p0 = array('d', bytes(8 * capacity))
+        self.p1 = array('d', bytes(8 * capacity))
+        self.p2 = array('d', bytes(8 * capacity))
+        self.fire = array('B', bytes(capacity))
+        self.samples = array('I', bytes(4 * capacity))
+        self.ts_last = array('d', bytes(8 * capacity))
+        self.seq_last = array('q', bytes(8 * capacity))
+        for name in ("lo0", "lo1", "lo2", "hi0", "hi1", "hi2"):
+            setattr(self, name, array('d', bytes(8 * capacity)))
+        self.next_row = 0
+        self.count = 0
+        self.by_node = {}
+        self.status_names = []
+        self.status_codes = {}
+        self.last_ts = 0.0    # newest sample ever stored
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def first_row(self):
+        return self.next_row - self.count
+
+    def status_code(self, name):
+        code = self.status_codes.get(name)
+        if code is None:
+            if len(self.status_names) >= 255:
+                # The column is one byte; once it is full, new statuses share
+                # a catch-all code rather than failing the write.
+                name = "Other"
+                code = self.status_codes.get(name)
+                if code is not None:
+                    return code
+            code = len(self.status_names)
+            self.status_names.append(name)
+            self.status_codes[name] = code
+        return code
+
+    def append(self, seq, node_id, ts, status, probs, fire):
+        row = self.next_row
+        i = row % self.capacity
+        if self.count == self.capacity:
+            self.by_node[self.node_id[i]].popleft()
+        else:
+            self.count += 1
+        self.next_row += 1
+        self.seq[i] = seq
+        self.node_id[i] = node_id
+        self.ts[i] = ts
+        self.status[i] = self.status_code(status)
+        self.p0[i], self.p1[i], self.p2[i] = probs
+        self.lo0[i], self.lo1[i], self.lo2[i] = probs
+        self.hi0[i], self.hi1[i], self.hi2[i] = probs
+        self.fire[i] = 1 if fire else 0
+        self.samples[i] = 1
+        self.ts_last[i] = ts
+        self.seq_last[i] = seq
+        self.last_ts = max(self.last_ts, ts)
+        index = self.by_node.get(node_id)
+        if index is None:
+            index = self.by_node[node_id] = NodeIndex()
+        index.append(row)
+        return row
+
+    def open_run(self, node_id, ts, status, fire, window):
+        # The node's latest row if a sample with this status can be folded into it.
+        index = self.by_node.get(node_id)
+        if window <= 0 or fire or status == "Community" or not index:
+            return None
+        row = index[len(index) - 1]
+        i = row % self.capacity
+        if self.fire[i] or self.status_names[self.status[i]] != status or ts - self.ts[i] >= window:
+            return None
+        return row
+
+    def extend(self, row, seq, ts, probs):
+        i = row % self.capacity
+        n = self.samples[i] + 1
+        self.samples[i] = n
+        self.ts_last[i] = ts
+        self.seq_last[i] = seq
+        self.last_ts = max(self.last_ts, ts)
+        for k, p in enumerate(probs):
+            mean, lo, hi = getattr(self, f"p{k}"), getattr(self, f"lo{k}"), getattr(self, f"hi{k}")
+            mean[i] += (p - mean[i]) / n
+            lo[i] = min(lo[i], p)
+            hi[i] = max(hi[i], p)
+
+    def row(self, row):
+        i = row % self.capacity
+        ts = self.ts[i]
+        event = {
+            "seq": self.seq[i],
+            "node_id": self.node_id[i],
+            "ts": ts,
+            "time": clock_str(ts),
+            "status": self.status_names[self.status[i]],
+            "probs": [self.p0[i], self.p1[i], self.p2[i]],
+            "fire": bool(self.fire[i]),
+        }
+        if self.samples[i] > 1:
+            # A run; `probs` is the mean.
+            event.update(count=self.samples[i], ts_last=self.ts_last[i], seq_last=self.seq_last[i],
+                         probs_min=[self.lo0[i], self.lo1[i], self.lo2[i]],
+                         probs_max=[self.hi0[i], self.hi1[i], self.hi2[i]])
+        return event
+
+    def slice(self, start=0, stop=None):
+        # Logical positions, 0 being the oldest retained event.
+        stop = self.count if stop is None else min(stop, self.count)
+        first = self.first_row
+        return [self.row(first + pos) for pos in range(max(start, 0), stop)]
+
+    def last(self, n):
+        return self.slice(self.count - n)
+
+    def since(self, seq):
+        # Rows started after `seq`, preceded by older runs that have grown since.
+        # A node's runs do not overlap in seq, so at most one of them straddles
+        # `seq`: its last row started at or before it, whether or not the node
+        # has moved on to newer rows since.
+        key = lambda r: self.seq[r % self.capacity]
+        rows = range(self.first_row, self.next_row)
+        lo = bisect_right(rows, seq, key=key)
+        grown = []
+        for index in self.by_node.values():
+            k = bisect_right(index, seq, key=key) - 1
+            if k >= 0 and self.seq_last[index[k] % self.capacity] > seq:
+                grown.append(index[k])
+        return [self.row(r) for r in sorted(grown)] + [self.row(r) for r in rows[lo:]]
+
+    def query(self, node_id=None, t_from=None, t_to=None, limit=None):
+        # Events with t_from <= ts < t_to, newest `limit` of them, oldest first.
+        # Returns (events, total number matching before the limit).
+        if node_id is None:
+            rows = range(self.first_row, self.next_row)
+        else:
+            rows = self.by_node.get(node_id)
+            if not rows:
+                return [], 0
+        key = lambda k: self.ts[rows[k] % self.capacity]
+        lo = 0 if t_from is None else bisect_left(range(len(rows)), t_from, key=key)
+        hi = len(rows) if t_to is None else bisect_left(range(len(rows)), t_to, key=key)
+        total = max(hi - lo, 0)
+        if limit is not None:
+            lo = max(lo, hi - limit)
+        return [self.row(rows[k]) for k in range(lo, hi)], total
+
+    def export(self):
+        # Header plus a copy of each column's raw bytes, for snapshots.
+        header = { "capacity": self.capacity, "next_row": self.next_row, "count": self.count, "status_names": list(self.status_names),
+                   "last_ts": self.last_ts }
+        return header, [(name, getattr(self, name).tobytes()) for name in self.COLUMNS]
+
+    def load(self, header, columns):
+        # `columns` maps column name to a bytes-like buffer from export().
+        if header["capacity"] != self.capacity:
+            # Capacity was reconfigured; re-append what fits, oldest first.
+            old = EventStore(header["capacity"])
+            old.load(header, columns)
+            self.__init__(self.capacity)
+            for row in range(old.first_row, old.next_row):
+                i = row % old.capacity
+                j = self.append(old.seq[i], old.node_id[i], old.ts[i], old.status_names[old.status[i]],
+                                (old.p0[i], old.p1[i], old.p2[i]), old.fire[i]) % self.capacity
+                for name in self.COLUMNS[8:]:
+                    getattr(self, name)[j] = getattr(old, name)[i]
+            return
+        for name in self.COLUMNS:
+            col = array(getattr(self, name).typecode)
+            if name in columns:
+                col.frombytes(columns[name])
+            elif name == "samples":
+                # Snapshot from before runs: every row is a single sample.
+                col = array('I', [1]) * self.capacity
+            else:
+                col.frombytes(columns[RUN_DEFAULTS[name]])
+            setattr(self, name, col)
+        self.next_row, self.count = header["next_row"], header["count"]
+        self.status_names = list(header["status_names"])
+        self.status_codes = { name: code for code, name in enumerate(self.status_names) }
+        self.last_ts = header.get("last_ts", max((self.ts_last[r % self.capacity] for r in range(self.first_row, self.next_row)), default=0.0))
+        self.by_node = {}
+        for row in range(self.first_row, self.next_row):
+            node_id = self.node_id[row % self.capacity]
+            index = self.by_node.get(node_id)
+            if index is None:
+                index = self.by_node[node_id] = NodeIndex()
+            index.append(row)
+
+# --- ANALYTICS ---
+# Running per-node class counts, winning-class probability sums and threat
+# sums, updated as each event is recorded so /analytics costs O(nodes) no
+# matter how long history is. Sliding windows keep the same stats in time
+# buckets and subtract a bucket's contribution when it ages out.
+ANALYTICS_CLASSES = ("Natural", "Unnatural", "Human", "Fire", "Community")
+ANALYTICS_WINDOWS = { "5m": (300, 10), "1h": (3600, 60) }   # name: (window, bucket) seconds
+CLASS_BY_STATUS = { "Natural": 0, "Unnatural": 1, "Human Sound": 2, "Community": 4 }
+
+# Per-node stats vector: counts per class, prob sums per class, event count, threat count, threat sum.
+N_CLASSES = len(ANALYTICS_CLASSES)
+EVENTS, THREAT_COUNT, THREAT_SUM = 2 * N_CLASSES, 2 * N_CLASSES + 1, 2 * N_CLASSES + 2
+
+def event_contribution(status, probs, fire):
+    # Mirrors how the dashboard classifies an event: fire wins, unknown
+    # statuses count as events only, and anything but Natural/Community is a
+    # threat scored by the Unnatural or Human probability.
+    cls = 3 if fire else CLASS_BY_STATUS.get(status)
+    prob = 0.0
+    if cls in (0, 1, 2):
+        prob = probs[cls]
+    elif cls == 4:
+        prob = 1.0
+    threat = None
+    if status not in ("Natural", "Community"):
+        threat = probs[1] if status == "Unnatural" else probs[2]
+    return cls, prob, threat
+
+class Rollup:
+    def __init__(self):
+        self.nodes = {}
+
+    def add(self, node_id, cls, prob, threat, sign=1):
+        vec = self.nodes.get(node_id)
+        if vec is None:
+            vec = self.nodes[node_id] = [0.0] * (EVENTS + 3)
+        if cls is not None:
+            vec[cls] += sign
+            vec[N_CLASSES + cls] += sign * prob
+        vec[EVENTS] += sign
+        if threat is not None:
+            vec[THREAT_COUNT] += sign
+            vec[THREAT_SUM] += sign * threat
+
+    def subtract(self, other):
+        for node_id, other_vec in other.nodes.items():
+            vec = self.nodes[node_id]
+            for k, v in enumerate(other_vec):
+                vec[k] -= v
+
+    def export(self):
+        return [[node_id, list(vec)] for node_id, vec in self.nodes.items()]
+
+    def load(self, items):
+        self.nodes = { node_id: list(vec) for node_id, vec in items }
+
+    def node_summary(self, node_id):
+        vec = self.nodes.get(node_id) or [0.0] * (EVENTS + 3)
+        return {
+            "events": int(round(vec[EVENTS])),
+            "counts": { name: int(round(vec[k])) for k, name in enumerate(ANALYTICS_CLASSES) },
+            "prob_sums": { name: round(max(vec[N_CLASSES + k], 0.0), 6) for k, name in enumerate(ANALYTICS_CLASSES) },
+            "threat_score": round(max(vec[THREAT_SUM], 0.0), 6),
+        }
+
+    def summary(self, node_id=None):
+        totals = [0.0] * (EVENTS + 3)
+        hotspot, best = None, 0.0
+        for n_id, vec in self.nodes.items():
+            for k, v in enumerate(vec):
+                totals[k] += v
+            # Same scoring as the old dashboard: count * mean threat probability.
+            if vec[THREAT_COUNT] >= 1 and (hotspot is None or vec[THREAT_SUM] > best):
+                hotspot, best = n_id, vec[THREAT_SUM]
+        result = {
+            "events": int(round(totals[EVENTS])),
+            "counts": { name: int(round(totals[k])) for k, name in enumerate(ANALYTICS_CLASSES) },
+            "hotspot": None if hotspot is None else { "node_id": hotspot, "score": round(best, 6) },
+        }
+        if node_id is not None:
+            result["node"] = self.node_summary(node_id)
+        return result
+
+class WindowedRollup(Rollup):
+    def __init__(self, window, bucket):
+        super().__init__()
+        self.window = window
+        self.bucket = bucket
+        self.buckets = deque()   # (bucket start, Rollup)
+
+    def add_at(self, ts, node_id, cls, prob, threat):
+        start = ts - ts % self.bucket
+        if not self.buckets or self.buckets[-1][0] < start:
+            self.buckets.append((start, Rollup()))
+        # Late events land in the newest bucket rather than reopening an old one.
+        self.buckets[-1][1].add(node_id, cls, prob, threat)
+        self.add(node_id, cls, prob, threat)
+        self.expire(ts)
+
+    def expire(self, now):
+        while self.buckets and self.buckets[0][0] + self.bucket <= now - self.window:
+            self.subtract(self.buckets.popleft()[1])
+
+    def export(self):
+        return { "totals": super().export(), "buckets": [[start, rollup.export()] for start, rollup in self.buckets] }
+
+    def load(self, data):
+        super().load(data["totals"])
+        self.buckets = deque()
+        for start, items in data["buckets"]:
+            rollup = Rollup()
+            rollup.load(items)
+            self.buckets.append((start, rollup))
+
+class Analytics:
+    def __init__(self):
+        self.all = Rollup()
+        self.windows = { name: WindowedRollup(*spec) for name, spec in ANALYTICS_WINDOWS.items() }
+
+    def add(self, node_id, ts, status, probs, fire):
+        cls, prob, threat = event_contribution(status, probs, fire)
+        self.all.add(node_id, cls, prob, threat)
+        for rollup in self.windows.values():
+            rollup.add_at(ts, node_id, cls, prob, threat)
+
+    def summary(self, window="all", node_id=None, now=None):
+        if window == "all":
+            return self.all.summary(node_id)
+        rollup = self.windows[window]
+        rollup.expire(time.time() if now is None else now)
+        return rollup.summary(node_id)
+
+    def export(self):
+        return { "all": self.all.export(), "windows": { name: rollup.export() for name, rollup in self.windows.items() } }
+
+    def load(self, data):
+        self.all.load(data["all"])
+        # Windows added since the snapshot start empty.
+        for name, rollup in self.windows.items():
+            if name in data["windows"]:
+                rollup.load(data["windows"][name])
+
+analytics = Analytics()
+
+# --- TIME SERIES ---
+# Tiered retention behind /timeseries. Raw samples live in the event store
+# (bounded by HISTORY_CAPACITY); every sample is also folded into per-node and
+# fleet-wide minute and hour buckets holding, per class, the sample count and
+# the sum, min and max of the plotted probability. Only classes that occur in a
+# bucket are stored, and per-node minute buckets are kept for a shorter time
+# than the fleet's, since sensors far outnumber the fleet series. A tier drops
+# buckets older than its retention as newer samples arrive, and about once an
+# hour every series is swept so nodes that went quiet are expired too. Expiry
+# follows sample time, not the wall clock, so replaying the log rebuilds the
+# same tiers.
+TIMESERIES_TIERS = {    # name: (bucket, fleet retention, per-node retention) seconds
+    "minute": (60, float(os.environ.get("KIOTA_MINUTE_RETENTION", 3 * 86400)),
+               float(os.environ.get("KIOTA_NODE_MINUTE_RETENTION", 86400))),
+    "hour": (3600, float(os.environ.get("KIOTA_HOUR_RETENTION", 90 * 86400)),
+             float(os.environ.get("KIOTA_NODE_HOUR_RETENTION", 90 * 86400))),
+}
+TIMESERIES_RAW_LIMIT = int(os.environ.get("KIOTA_TIMESERIES_RAW_LIMIT", 1000))
+TIMESERIES_SCAN_LIMIT = int(os.environ.get("KIOTA_TIMESERIES_SCAN_LIMIT", 5000))
+TIMESERIES_MAX_POINTS = 5000
+TIMESERIES_SWEEP_SECONDS = 3600
+SERIES_EMPTY = array('d', [0.0, 0.0, math.inf, -math.inf])    # count, sum, min, max
+FLEET = -1    # series key for all nodes together
+
+def series_value(status, probs, fire):
+    # (class index, value) of a sample as the timeline plots it; fire and
+    # community reports sit at 1.0.
+    cls, prob, _ = event_contribution(status, probs, fire)
+    return cls, 1.0 if cls in (3, 4) else prob
+
+class BucketSeries:
+    # One node's buckets of one width in parallel columns, one entry per
+    # (bucket start, class) that has samples, sorted by start then class.
+    def __init__(self, width, retention):
+        self.width = width
+        self.retention = retention
+        self.start = array('d')
+        self.cls = array('B')
+        self.stats = array('d')    # 4 per entry
+
+    def __len__(self):
+        return len(self.start)
+
+    def add(self, ts, cls, value):
+        start = ts - ts % self.width
+        n = len(self.start)
+        opened = n == 0 or self.start[n - 1] < start
+        if opened:
+            k = n
+        else:
+            # Same or an older bucket; a late sample whose bucket expired is dropped.
+            if start + self.width <= self.start[n - 1] - self.retention:
+                return
+            k = bisect_left(self.start, start)
+            while k < n and self.start[k] == start and self.cls[k] < cls:
+                k += 1
+        if k == n or self.start[k] != start or self.cls[k] != cls:
+            self.start.insert(k, start)
+            self.cls.insert(k, cls)
+            self.stats[4 * k:4 * k] = SERIES_EMPTY
+        i = 4 * k
+        stats = self.stats
+        stats[i] += 1
+        stats[i + 1] += value
+        stats[i + 2] = min(stats[i + 2], value)
+        stats[i + 3] = max(stats[i + 3], value)
+        if opened:
+            self.expire(ts)
+
+    def expire(self, now):
+        cut = bisect_right(self.start, now - self.retention - self.width)
+        if cut:
+            del self.start[:cut]
+            del self.cls[:cut]
+            del self.stats[:4 * cut]
+
+    def points(self, t_from, t_to):
+        # Per class, [start, mean, min, max, count] of each bucket overlapping [t_from, t_to).
+        lo = bisect_right(self.start, t_from - self.width)
+        hi = bisect_left(self.start, t_to)
+        series = [[] for _ in range(N_CLASSES)]
+        stats = self.stats
+        for k in range(lo, hi):
+            i = 4 * k
+            n = stats[i]
+            series[self.cls[k]].append([self.start[k], stats[i + 1] / n, stats[i + 2], stats[i + 3], int(n)])
+        return series
+
+    def load_dense(self, start, stats):
+        # Snapshots from before sparse buckets hold every class of every bucket.
+        starts, dense = array('d'), array('d')
+        starts.frombytes(start)
+        dense.frombytes(stats)
+        for k, bucket in enumerate(starts):
+            for cls in range(N_CLASSES):
+                i = (k * N_CLASSES + cls) * 4
+                if dense[i]:
+                    self.start.append(bucket)
+                    self.cls.append(cls)
+                    self.stats.extend(dense[i:i + 4])
+
+class TimeSeries:
+    def __init__(self):
+        self.series = {}    # (tier, node_id or FLEET) -> BucketSeries
+        self.swept = 0.0
+
+    def add(self, node_id, ts, status, probs, fire):
+        cls, value = series_value(status, probs, fire)
+        if cls is None:
+            return
+        for key in (node_id, FLEET):
+            for tier, (width, fleet_retention, node_retention) in TIMESERIES_TIERS.items():
+                series = self.series.get((tier, key))
+                if series is None:
+                    series = self.series[(tier, key)] = BucketSeries(width, fleet_retention if key == FLEET else node_retention)
+                series.add(ts, cls, value)
+        if ts - self.swept >= TIMESERIES_SWEEP_SECONDS:
+            self.sweep(ts)
+
+    def sweep(self, now):
+        # Expires every series, including those no sample has touched lately, and drops the empty ones.
+        for key, series in list(self.series.items()):
+            series.expire(now)
+            if not len(series):
+                del self.series[key]
+        self.swept = now
+
+    def points(self, tier, node_id, t_from, t_to):
+        series = self.series.get((tier, FLEET if node_id is None else node_id))
+        return series.points(t_from, t_to) if series else [[] for _ in range(N_CLASSES)]
+
+    def export(self):
+        # Header for the snapshot plus each series' raw columns.
+        keys = [[tier, key] for tier, key in self.series]
+        columns = []
+        for (tier, key), series in self.series.items():
+            for name in ("start", "cls", "stats"):
+                columns.append((f"series/{tier}/{key}/{name}", getattr(series, name).tobytes()))
+        return { "keys": keys, "swept": self.swept }, columns
+
+    def load(self, header, columns):
+        # Tiers that are not in the snapshot start empty. Older snapshots have
+        # a bare list of keys and dense buckets.
+        if isinstance(header, list):
+            header = { "keys": header }
+        self.series = {}
+        self.swept = header.get("swept", 0.0)
+        for tier, key in header["keys"]:
+            if tier not in TIMESERIES_TIERS:
+                continue
+            width, fleet_retention, node_retention = TIMESERIES_TIERS[tier]
+            series = self.series[(tier, key)] = BucketSeries(width, fleet_retention if key == FLEET else node_retention)
+            prefix = f"series/{tier}/{key}/"
+            if prefix + "cls" not in columns:
+                series.load_dense(columns[prefix + "start"], columns[prefix + "stats"])
+                continue
+            for name in ("start", "cls", "stats"):
+                getattr(series, name).frombytes(columns[prefix + name])
+
+def lttb(points, n):
+    # Largest-Triangle-Three-Buckets: picks n of `points` (sorted by x, y in
+    # position 1) that best keep the shape of the line.
+    if n >= len(points):
+        return points
+    if n < 3:
+        return [points[0], points[-1]][:n]
+    out = [points[0]]
+    every = (len(points) - 2) / (n - 2)
+    a = 0
+    for b in range(n - 2):
+        lo, hi = int(b * every) + 1, int((b + 1) * every) + 1
+        following = points[hi:min(int((b + 2) * every) + 1, len(points))]
+        avg_x = sum(p[0] for p in following) / len(following)
+        avg_y = sum(p[1] for p in following) / len(following)
+        ax, ay = points[a][0], points[a][1]
+        best, best_area = lo, -1.0
+        for j in range(lo, hi):
+            area = abs((ax - avg_x) * (points[j][1] - ay) - (ax - points[j][0]) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+        out.append(points[best])
+        a = best
+    out.append(points[-1])
+    return out
+
+timeseries = TimeSeries()
+
 # --- STATE ---
+# Every node change, history event and ledger block is stamped with a value from
+# one monotonic sequence so dashboards can poll /status?since=<seq> for deltas.
+# Writers allocate the seq and publish under state_lock, so a reader never sees
+# a cursor ahead of the data it covers.
+state_lock = threading.RLock()
+state_seq = 0
+
+def next_seq():
+    global state_seq
+    state_seq += 1
+    return state_seq
+
 node_states = {}
+node_index = SpatialIndex(MATCH_TOLERANCE_M)
+proximity = ProximityEngine()
 for node in NODE_LOCATIONS:
     node_states[node["id"]] = {
-        **node, "status": "Natural", "probs": [1.0, 0.0, 0.0], "fire": False, "last_update": "Waiting..."
+        **node, "status": "Natural", "probs": [1.0, 0.0, 0.0], "fire": False, "at_risk": None, "last_update": "Waiting...", "seq": 0
     }
+    node_index.insert(node["id"], node["lat"], node["lng"])
+    proximity.insert(node["id"], node["lat"], node["lng"])
+
+def register_node(lat, lng, name=None, node_id=None, ts=None):
+    # Caller holds state_lock. Adds a sensor, or moves an existing one.
+    if node_id is None:
+        node_id = max(node_states, default=-1) + 1
+    moved = node_id in node_states
+    # Indexes first, so a location they reject leaves no half-registered node.
+    node_index.insert(node_id, lat, lng)
+    proximity.insert(node_id, lat, lng)
+    if node_id in node_states:
+        node_states[node_id].update(lat=lat, lng=lng, name=name or node_states[node_id]["name"])
+    else:
+        node = {"id": node_id, "lat": lat, "lng": lng, "name": name or f"Node {node_id}"}
+        NODE_LOCATIONS.append(node)
+        node_states[node_id] = {**node, "status": "Natural", "probs": [1.0, 0.0, 0.0], "fire": False, "at_risk": None, "last_update": "Waiting..."}
+    update_node(node_id)
+    # Risk flags hang on distances: recheck the node itself, anything flagged
+    # from it, and, if it is burning, its new neighbourhood.
+    refresh_fire_risk(node_id, ts)
+    if moved:
+        for n_id, state in node_states.items():
+            if state.get("at_risk") and state["at_risk"]["source"] == node_id:
+                refresh_fire_risk(n_id, ts)
+        if node_states[node_id]["fire"]:
+            update_fire_risk(node_id, ts)
+    return node_states[node_id]
+
+def resolve_node(d):
+    # Explicit node_id wins; otherwise the nearest node within tolerance of lat/lng.
+    node_id = d.get('node_id')
+    if node_id is not None:
+        if not isinstance(node_id, int) or isinstance(node_id, bool):
+            return None
+        return node_id if node_id in node_states else None
+    try:
+        lat, lng = float(d['lat']), float(d['lng'])
+    except (KeyError, TypeError, ValueError):
+        return None
+    if not valid_location(lat, lng):
+        return None
+    hit = node_index.nearest(lat, lng, MATCH_TOLERANCE_M)
+    return hit[0] if hit else None
+
+event_history = EventStore(HISTORY_CAPACITY)
+
+def record_event(node_id, ts, status, probs, fire):
+    # Caller holds state_lock. `ts` is epoch seconds. History is kept in ts
+    # order for the bisects in EventStore.query() and find_incidents(), so a
+    # sample stamped before the newest one (another worker's clock, a request
+    # that waited for the lock, the priority lane) is moved up to it. Every
+    # replica applies the log in the same order and clamps the same way.
+    ts = max(ts, event_history.last_ts)
+    seq = next_seq()
+    row = event_history.open_run(node_id, ts, status, fire, COALESCE_SECONDS)
+    if row is None:
+        row = event_history.append(seq, node_id, ts, status, probs, fire)
+    else:
+        event_history.extend(row, seq, ts, probs)
+    analytics.add(node_id, ts, status, probs, fire)
+    timeseries.add(node_id, ts, status, probs, fire)
+    if event_hub.subscribers:
+        event_hub.publish("event", event_history.row(row))
+    return seq
 
-# FIX: Use a List (unlimited) instead of Deque (limited)
-event_history = [] 
-
-# Pre-fill with dummy data for visual check
-curr = datetime.datetime.now()
-for i in range(50):
-    t = curr - datetime.timedelta(seconds=(50-i)*2)
-    rand = random.random()
-    if rand < 0.7:
-        status = "Natural"; probs = [0.9, 0.05, 0.05]
-    elif rand < 0.85:
-        status = "Unnatural"; probs = [0.1, 0.8, 0.1]
+def update_node(node_id, **fields):
+    # Caller holds state_lock.
+    node_states[node_id].update(fields, seq=next_seq())
+    event_hub.publish("node", node_states[node_id])
+
+def add_ledger_block(data, ts):
+    # Caller holds state_lock.
+    block = community_ledger.create_block(100, community_ledger.last_hash(), data, seq=next_seq(), ts=ts)
+    event_hub.publish("block", block)
+    return block
+
+def report_ref(node_id, ts, issue, reporter):
+    # Short id a reporter can later look up at /ledger/proof/<report_id>.
+    return hashlib.sha256(f"{reporter}|{node_id}|{issue}|{ts!r}".encode()).hexdigest()[:16]
+
+def add_ledger_report(report, ts):
+    # Caller holds state_lock. Batches seal on size or age; the age check also
+    # runs from a timer (see LedgerSealer) so a quiet period still closes a batch.
+    if LEDGER_BATCH_SIZE <= 1:
+        return add_ledger_block(report, ts)
+    community_ledger.pending.append(report)
+    if len(community_ledger.pending) >= LEDGER_BATCH_SIZE or ts - community_ledger.pending[0]["ts"] >= LEDGER_BATCH_SECONDS:
+        seal_ledger_batch(ts)
+
+def seal_ledger_batch(ts):
+    # Caller holds state_lock.
+    reports = community_ledger.pending
+    if not reports:
+        return None
+    community_ledger.pending = []
+    return add_ledger_block({"reports": reports}, ts)
+
+STATUS_MAX_LENGTH = 32
+
+def parse_alert(d):
+    # Validates a sensor alert body; returns (status, probs, fire) or raises ValueError.
+    if not isinstance(d, dict):
+        raise ValueError("alert must be a JSON object")
+    status = d.get('class')
+    if not isinstance(status, str) or not 0 < len(status) <= STATUS_MAX_LENGTH or not status.isprintable():
+        raise ValueError(f"'class' must be a printable string of at most {STATUS_MAX_LENGTH} characters")
+    probs = d.get('probs')
+    if not isinstance(probs, list) or len(probs) != 3:
+        raise ValueError("'probs' must be a list of three numbers")
+    try:
+        probs = [float(p) for p in probs]
+    except (TypeError, ValueError):
+        raise ValueError("'probs' must be a list of three numbers")
+    return status, probs, bool(d.get('fire', False))
+
+def apply_alert(node_id, ts, status, probs, fire):
+    # Caller holds state_lock. Returns the seq of the history event.
+    was_burning = node_states[node_id]["fire"]
+    update_node(node_id, status=status, probs=probs, fire=fire, last_update=clock_str(ts))
+    seq = record_event(node_id, ts, status, probs, fire)
+    if fire != was_burning:
+        update_fire_risk(node_id, ts)
+    return seq
+
+def nearest_fire(node_id):
+    # Caller holds state_lock. The closest burning node within FIRE_RADIUS_M as (id, metres), or None.
+    ids, dists = proximity.select(proximity.row(node_id), radius_m=FIRE_RADIUS_M, exclude=node_id)
+    for n_id, dist in zip(ids.tolist(), dists.tolist()):
+        if node_states[n_id]["fire"]:
+            return n_id, dist
+    return None
+
+def update_fire_risk(source, ts):
+    # Caller holds state_lock. `source` just caught or stopped reporting fire:
+    # nodes within FIRE_RADIUS_M are flagged at risk from their nearest fire,
+    # or cleared when no fire is left in range.
+    ids, dists = proximity.select(proximity.row(source), radius_m=FIRE_RADIUS_M, exclude=source)
+    burning = node_states[source]["fire"]
+    for n_id, dist in zip(ids.tolist(), dists.tolist()):
+        current = node_states[n_id].get("at_risk")
+        if burning:
+            if current is None or dist < current["distance_m"]:
+                update_node(n_id, at_risk={"source": source, "distance_m": round(dist, 1), "since": ts})
+        elif current is not None and current["source"] == source:
+            refresh_fire_risk(n_id, ts)
+
+def refresh_fire_risk(node_id, ts):
+    # Caller holds state_lock. Sets node_id's flag from its nearest fire now.
+    hit = nearest_fire(node_id)
+    current = node_states[node_id].get("at_risk")
+    if hit is None:
+        flag = None
+    elif current is not None and current["source"] == hit[0]:
+        flag = dict(current, distance_m=round(hit[1], 1))
     else:
-        status = "Human Sound"; probs = [0.1, 0.1, 0.8]
+        flag = {"source": hit[0], "distance_m": round(hit[1], 1), "since": ts}
+    if flag != current:
+        update_node(node_id, at_risk=flag)
+
+def apply_report(node_id, ts, issue, reporter, ref=None):
+    # Caller holds state_lock. Returns the seq of the history event. `ref` is
+    # the id already handed to the reporter, if `ts` has moved since.
+    target = node_states[node_id]
+    was_burning = target["fire"]
+    # 1. Add to Blockchain
+    data = {"issue": issue, "loc": target['name'], "lat": target['lat'], "lng": target['lng'], "reporter": reporter,
+            "ts": ts, "report_id": ref or report_ref(node_id, ts, issue, reporter)}
+    add_ledger_report(data, ts)
+    # 2. Register as Alert Event (Updates UI & History)
+    update_node(node_id, status=f"Community Report: {issue}", probs=[0.0, 0.0, 0.0], fire=False, last_update=clock_str(ts))
+    seq = record_event(node_id, ts, "Community", [0.0, 0.0, 0.0], False)
+    if was_burning:
+        update_fire_risk(node_id, ts)
+    return seq
 
-    event_history.append({
-        "node_id": random.randint(0, 14), 
-        "time": t.strftime("%H:%M:%S"), 
-        "status": status, 
-        "probs": probs, 
-        "fire": False
-    })
+def apply_record(rec):
+    # Caller holds state_lock. Every state change is one of these records, and
+    # applying the same records in the same order always yields the same state
+    # and the same seqs, which is what lets workers share one log.
+    kind = rec["k"]
+    if kind == "alert":
+        return apply_alert(rec["node"], rec["ts"], rec["status"], rec["probs"], rec["fire"])
+    if kind == "event":
+        return record_event(rec["node"], rec["ts"], rec["status"], rec["probs"], rec["fire"])
+    if kind == "report":
+        return apply_report(rec["node"], rec["ts"], rec["issue"], rec["reporter"], rec.get("ref"))
+    if kind == "seal":
+        return seal_ledger_batch(rec["ts"])
+    if kind == "node":
+        return register_node(rec["lat"], rec["lng"], rec.get("name"), rec.get("id"), rec.get("ts"))["id"]
+    raise ValueError(f"unknown record kind {kind!r}")
+
+def check_record(rec):
+    # Caller holds state_lock. Raises ValueError if apply_record() would fail
+    # on `rec` against the current state, before it is written to the log.
+    if not isinstance(rec, dict):
+        raise ValueError("record must be an object")
+    kind = rec.get("k")
+    if kind not in ("alert", "event", "report", "seal", "node"):
+        raise ValueError(f"unknown record kind {kind!r}")
+    if not isinstance(rec.get("ts", 0.0), (int, float)):
+        raise ValueError("'ts' must be a number")
+    if kind == "node":
+        lat, lng = rec.get("lat"), rec.get("lng")
+        if not isinstance(lat, (int, float)) or not isinstance(lng, (int, float)) or not valid_location(lat, lng):
+            raise ValueError("'lat' and 'lng' must be finite coordinates")
+        node_id = rec.get("id")
+        if node_id is not None and (not isinstance(node_id, int) or isinstance(node_id, bool) or node_id < 0):
+            raise ValueError("'id' must be a non-negative integer")
+        if rec.get("name") is not None and not isinstance(rec["name"], str):
+            raise ValueError("'name' must be a string")
+        return
+    if kind == "seal":
+        return
+    if rec.get("node") not in node_states:
+        raise ValueError(f"unknown node {rec.get('node')!r}")
+    if kind == "report":
+        if not isinstance(rec.get("issue"), str) or not isinstance(rec.get("reporter"), str):
+            raise ValueError("'issue' and 'reporter' must be strings")
+        return
+    parse_alert({"class": rec.get("status"), "probs": rec.get("probs"), "fire": rec.get("fire")})
+
+def apply_or_skip(rec, where):
+    # Caller holds state_lock. Applies a record already in the log; one that
+    # fails is logged and skipped rather than aborting replay, so every
+    # replica steps over it the same way. Returns the result or the exception.
+    try:
+        return apply_record(rec)
+    except Exception as e:
+        app.logger.exception("state: skipped record at %s: %.200r", where, rec)
+        return e
+
+def export_state():
+    # Caller holds state_lock. The ledger itself goes to its own append-only
+    # log (see LedgerLog); the snapshot only records its height.
+    header, columns = event_history.export()
+    meta = {
+        "state_seq": state_seq,
+        "nodes": [dict(n) for n in node_states.values()],
+        "ledger_height": len(community_ledger.chain),
+        "ledger_pending": list(community_ledger.pending),
+        "events": header,
+        "analytics": analytics.export(),
+    }
+    meta["timeseries"], series_columns = timeseries.export()
+    return meta, columns + series_columns
+
+def restore_state(meta, columns, blocks=None):
+    # Caller holds state_lock. Inverse of export_state(); `blocks` is
+    # (chain, hashes) from the ledger log. Older snapshots carry the chain.
+    global state_seq
+    state_seq = meta["state_seq"]
+    node_states.clear()
+    NODE_LOCATIONS[:] = []
+    for n in meta["nodes"]:
+        node_states[n["id"]] = n
+        NODE_LOCATIONS.append({"id": n["id"], "lat": n["lat"], "lng": n["lng"], "name": n["name"]})
+        node_index.insert(n["id"], n["lat"], n["lng"])
+        proximity.insert(n["id"], n["lat"], n["lng"])
+    if "ledger" in meta:
+        blocks = meta["ledger"], meta.get("ledger_hashes")
+    community_ledger.load(*blocks, meta.get("ledger_pending", ()))
+    event_history.load(meta["events"], columns)
+    analytics.load(meta["analytics"])
+    timeseries.load(meta.get("timeseries", []), columns)
+
+# --- PERSISTENCE ---
+# With KIOTA_DATA_DIR set, state survives restarts. Records are appended to a
+# write-ahead log and a request is only acknowledged once its records are
+# fsynced; a flusher thread fsyncs whatever has accumulated, so concurrent
+# requests share one fsync (group commit). Every KIOTA_SNAPSHOT_EVERY records or
+# KIOTA_SNAPSHOT_INTERVAL seconds the replica is snapshotted and the WAL
+# segments it covers are deleted, so startup loads one snapshot and replays
+# only the tail.
+DATA_DIR = os.environ.get("KIOTA_DATA_DIR")
+SNAPSHOT_EVERY = int(os.environ.get("KIOTA_SNAPSHOT_EVERY", 50000))
+SNAPSHOT_INTERVAL = float(os.environ.get("KIOTA_SNAPSHOT_INTERVAL", 300))
+WAL_COMMIT_DELAY = float(os.environ.get("KIOTA_WAL_COMMIT_DELAY", 0.002))
+DEMO_DATA = os.environ.get("KIOTA_DEMO_DATA", "") not in ("", "0")
+
+def fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class WriteAheadLog:
+    # Segment files wal-<first lsn>.log hold one record per line as
+    # "<crc32> <json>". Replay stops at the first line whose checksum fails,
+    # which can only be a write torn by a crash, and truncates it away.
+    def __init__(self, directory, commit_delay):
+        self.directory = directory
+        self.commit_delay = commit_delay
+        self.cond = threading.Condition()
+        self.sync_lock = threading.Lock()
+        self.lsn = 0
+        self.durable_lsn = 0
+        self.file = None
+
+    def segments(self):
+        names = sorted(n for n in os.listdir(self.directory) if n.startswith("wal-") and n.endswith(".log"))
+        return [(int(n[4:-4]), os.path.join(self.directory, n)) for n in names]
+
+    def replay(self, after):
+        # Yields (lsn, record) for every record after `after`, the position of
+        # the snapshot the caller restored.
+        lsn = after
+        segments = self.segments()
+        for k, (start, path) in enumerate(segments):
+            if k + 1 < len(segments) and segments[k + 1][0] <= after + 1:
+                continue
+            if start > lsn + 1:
+                raise RuntimeError(f"WAL gap: expected record {lsn + 1}, {path} starts at {start}")
+            n, good = start - 1, 0
+            with open(path, 'rb') as f:
+                for line in f:
+                    crc, _, body = line.rstrip(b"\n").partition(b" ")
+                    try:
+                        ok = line.endswith(b"\n") and int(crc, 16) == zlib.crc32(body)
+                    except ValueError:
+                        ok = False
+                    if not ok:
+                        break
+                    good += len(line)
+                    n += 1
+                    if n > after:
+                        yield n, json.loads(body)
+            if good < os.path.getsize(path):
+                with open(path, 'r+b') as f:
+                    f.truncate(good)
+            lsn = max(lsn, n)
+        self.lsn = self.durable_lsn = lsn
+
+    def open(self):
+        # Call after replay(). New records go to a segment starting at lsn + 1.
+        self.file = open(os.path.join(self.directory, f"wal-{self.lsn + 1:020d}.log"), 'ab')
+        fsync_dir(self.directory)
+        threading.Thread(target=self._flush_loop, daemon=True).start()
+
+    def write(self, records):
+        with self.cond:
+            for rec in records:
+                body = json.dumps(rec, separators=(",", ":")).encode()
+                self.file.write(b"%08x %s\n" % (zlib.crc32(body), body))
+            self.lsn += len(records)
+            self.cond.notify_all()
+            return self.lsn
+
+    def wait_durable(self, lsn):
+        with self.cond:
+            while self.durable_lsn < lsn:
+                self.cond.wait()
+
+    def _flush_loop(self):
+        while True:
+            with self.cond:
+                while self.durable_lsn >= self.lsn:
+                    self.cond.wait()
+            # Give concurrent writers a moment to join this commit.
+            if self.commit_delay > 0:
+                time.sleep(self.commit_delay)
+            self.sync()
+
+    def sync(self):
+        with self.sync_lock:
+            with self.cond:
+                target = self.lsn
+                self.file.flush()
+                fd = self.file.fileno()
+            os.fsync(fd)
+            with self.cond:
+                self.durable_lsn = max(self.durable_lsn, target)
+                self.cond.notify_all()
+
+    def rotate(self):
+        # Seals the current segment so the next record starts a new one.
+        with self.sync_lock:
+            with self.cond:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.file.close()
+                self.durable_lsn = self.lsn
+                self.file = open(os.path.join(self.directory, f"wal-{self.lsn + 1:020d}.log"), 'ab')
+                self.cond.notify_all()
+        fsync_dir(self.directory)
+
+    def truncate_through(self, lsn):
+        # Deletes sealed segments whose records are all covered by a snapshot at `lsn`.
+        segments = self.segments()
+        for (start, path), (next_start, _) in zip(segments, segments[1:]):
+            if next_start - 1 <= lsn:
+                os.remove(path)
+
+class LedgerLog:
+    # ledger.log holds the chain one block per line as "<hash> <json>". Blocks
+    # never change, so each snapshot appends only the blocks sealed since the
+    # last one and records the height; the log is fsynced before the snapshot
+    # that relies on it. Several processes may snapshot into one directory
+    # (sqlite backend), so the file, not this object, says how many blocks are
+    # there, and it is only written or cut back under SnapshotStore.locked().
+    def __init__(self, directory):
+        self.path = os.path.join(directory, "ledger.log")
+        self.height = 0    # complete lines in the first `size` bytes
+        self.size = 0
+        self.last_hash = None
+
+    def scan(self):
+        # Catches up with lines other processes have appended. A torn last
+        # line from a writer that crashed is not counted.
+        try:
+            size = os.path.getsize(self.path)
+        except FileNotFoundError:
+            size = 0
+        if size < self.size:
+            self.height, self.size, self.last_hash = 0, 0, None
+        if size == self.size:
+            return
+        with open(self.path, 'rb') as f:
+            f.seek(self.size)
+            data = f.read(size - self.size)
+        complete = data[:data.rfind(b"\n") + 1]
+        if complete:
+            self.height += complete.count(b"\n")
+            self.size += len(complete)
+            self.last_hash = complete[complete.rfind(b"\n", 0, -1) + 1:][:64].decode()
+
+    def missing(self, chain, hashes, height):
+        # Caller holds the snapshot lock and state_lock. (start, blocks, hashes)
+        # that the file lacks to reach `height`; raises if it holds a different chain.
+        self.scan()
+        k = min(self.height, height)
+        if k and hashes[k - 1] != self._hash_at(k):
+            raise RuntimeError(f"ledger log does not match the chain at block {k}")
+        return self.height, chain[self.height:height], hashes[self.height:height]
+
+    def _hash_at(self, k):
+        if k == self.height:
+            return self.last_hash
+        with open(self.path, 'rb') as f:
+            for i, line in enumerate(f, 1):
+                if i == k:
+                    return line[:64].decode()
+
+    def restore(self, height):
+        # Caller holds the snapshot lock. Returns (chain, hashes) for the first
+        # `height` blocks, the chain as a BlockList, and cuts off lines past
+        # them: no snapshot covers those, so a writer crashed before finishing.
+        with open(self.path, 'a+b') as f:
+            f.seek(0)
+            lines = f.read().split(b"\n")
+            if len(lines) - 1 < height:
+                raise RuntimeError(f"ledger log has {len(lines) - 1} blocks, snapshot needs {height}")
+            size = sum(len(line) + 1 for line in lines[:height])
+            if f.tell() > size:
+                f.truncate(size)
+        lines = lines[:height]
+        self.height, self.size = height, size
+        self.last_hash = lines[-1][:64].decode() if lines else None
+        return BlockList([line[65:] for line in lines]), [line[:64].decode() for line in lines]
+
+    def append(self, start, blocks, hashes):
+        # Caller holds the snapshot lock.
+        if not blocks:
+            return
+        if start != self.height:
+            raise RuntimeError(f"ledger log moved to {self.height} blocks, expected {start}")
+        with open(self.path, 'ab') as f:
+            f.truncate(self.size)    # a torn line left by a crashed writer
+            for block, h in zip(blocks, hashes):
+                f.write(b"%s %s\n" % (h.encode(), json.dumps(block, separators=(",", ":")).encode()))
+            f.flush()
+            os.fsync(f.fileno())
+            self.size = f.tell()
+        self.height += len(blocks)
+        self.last_hash = hashes[-1]
+
+class SnapshotStore:
+    # snapshot-<position>.cols holds the event-store columns back to back and
+    # snapshot-<position>.json everything else plus the column offsets. The
+    # .json is renamed into place last, so its presence marks a complete
+    # snapshot. Columns are read back through mmap.
+    def __init__(self, directory):
+        self.directory = directory
+        self.ledger = LedgerLog(directory)
+
+    def locked(self):
+        # Exclusive lock on the directory across processes, released when the
+        # returned file is closed. Taken before state_lock.
+        f = open(os.path.join(self.directory, "snapshot.lock"), 'a')
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+    def _path(self, position, ext):
+        return os.path.join(self.directory, f"snapshot-{position:020d}.{ext}")
+
+    def positions(self):
+        names = os.listdir(self.directory)
+        return sorted(int(n[9:-5]) for n in names if n.startswith("snapshot-") and n.endswith(".json"))
+
+    def write(self, position, meta, columns, blocks=(0, (), ())):
+        # Caller holds locked(). `blocks` is what LedgerLog.missing() returned.
+        self.ledger.append(*blocks)
+        offsets, offset = {}, 0
+        tmp = f".tmp-{os.getpid()}"
+        with open(self._path(position, "cols") + tmp, 'wb') as f:
+            for name, data in columns:
+                f.write(data)
+                offsets[name] = [offset, len(data)]
+                offset += len(data)
+            f.flush()
+            os.fsync(f.fileno())
+        with open(self._path(position, "json") + tmp, 'w') as f:
+            json.dump({ "position": position, "columns": offsets, "state": meta }, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self._path(position, "cols") + tmp, self._path(position, "cols"))
+        os.replace(self._path(position, "json") + tmp, self._path(position, "json"))
+        fsync_dir(self.directory)
+
+    def restore_latest(self):
+        # Caller holds state_lock; runs at startup, before this process
+        # snapshots. Restores the newest snapshot; returns its position, or 0.
+        with self.locked():
+            positions = self.positions()
+            if not positions:
+                self.ledger.restore(0)
+                return 0
+            position = positions[-1]
+            with open(self._path(position, "json")) as f:
+                snap = json.load(f)
+            blocks = self.ledger.restore(snap["state"].get("ledger_height", 0))
+        with open(self._path(position, "cols"), 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+            view = memoryview(mm)
+            try:
+                columns = { name: view[off:off + n] for name, (off, n) in snap["columns"].items() }
+                restore_state(snap["state"], columns, blocks)
+            finally:
+                columns = None
+                view.release()
+                if size:
+                    mm.close()
+        return position
+
+    def prune(self, keep):
+        for position in self.positions()[:-keep]:
+            for ext in ("json", "cols"):
+                try:
+                    os.remove(self._path(position, ext))
+                except FileNotFoundError:
+                    pass
+
+class Snapshotter:
+    def __init__(self, store, every, interval):
+        self.store = store
+        self.every = every
+        self.interval = interval
+        self.position = 0
+        self.taken_at = time.monotonic()
+        self.pid = None
+        self.lock = threading.Lock()    # one snapshot at a time within the process
+
+    def start(self, position):
+        self.position = position
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            threading.Thread(target=self._loop, daemon=True).start()
+
+    def _loop(self):
+        while True:
+            time.sleep(1.0)
+            pending = state_backend.position - self.position
+            if pending >= self.every or (pending > 0 and time.monotonic() - self.taken_at >= self.interval):
+                self.snapshot()
+
+    def snapshot(self):
+        # With the sqlite backend every worker runs one of these against the
+        # same directory; the directory lock lets one write at a time, and a
+        # worker whose replica is not ahead of the newest snapshot skips.
+        with self.lock, self.store.locked():
+            with state_lock:
+                position = state_backend.position
+                if self.store.positions()[-1:] >= [position]:
+                    self.position, self.taken_at = position, time.monotonic()
+                    return
+                meta, columns = export_state()
+                blocks = self.store.ledger.missing(community_ledger.chain, community_ledger.hashes, meta["ledger_height"])
+                state_backend.begin_checkpoint()
+            # Serializing and fsyncing happen outside state_lock; writers keep going.
+            self.store.write(position, meta, columns, blocks)
+            state_backend.end_checkpoint(position)
+            self.store.prune(keep=2)
+            self.position, self.taken_at = position, time.monotonic()
+
+# --- STATE BACKEND ---
+# Where the record log lives and how processes agree on its order.
+#
+# memory: the module globals are the only copy and state_lock is the only lock.
+#   Correct for one process with any number of threads (gunicorn -w 1 --threads N
+#   or -k gevent); extra workers would each see private state. With
+#   KIOTA_DATA_DIR set, records also go to the write-ahead log above.
+#
+# sqlite: records are appended to a table in a SQLite database in WAL mode and
+#   every worker keeps its globals as a replica of that log. SQLite's write lock
+#   (BEGIN IMMEDIATE) fixes the global order of records; within a process
+#   state_lock serialises appends, replay and reads. Reads call sync() first, so
+#   a worker answers with every record committed before the request began, and
+#   a poller thread replays other workers' records so /stream sees them too.
+#   Seqs match across workers because every replica applies the same log.
+#
+# `position` is how many log records the replica has applied (the WAL lsn or
+# the SQLite row id); snapshots are tagged with it.
+STATE_BACKEND = os.environ.get("KIOTA_STATE_BACKEND", "memory")
+STATE_PATH = os.environ.get("KIOTA_STATE_PATH", "kiota_state.db")
+STATE_POLL_INTERVAL = float(os.environ.get("KIOTA_STATE_POLL_INTERVAL", 0.5))
+
+class MemoryBackend:
+    def __init__(self, wal=None):
+        self.wal = wal
+        self.position = 0
+
+    def created(self):
+        if self.wal is None:
+            return time.time()
+        path = os.path.join(self.wal.directory, "created")
+        if not os.path.exists(path):
+            with open(path + ".tmp", 'w') as f:
+                f.write(repr(time.time()))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + ".tmp", path)
+        with open(path) as f:
+            return float(f.read())
+
+    def open(self, position):
+        # Caller holds state_lock. Replays the WAL tail after a restored snapshot.
+        self.position = position
+        if self.wal is not None:
+            for lsn, rec in self.wal.replay(position):
+                apply_or_skip(rec, f"wal {lsn}")
+                self.position = lsn
+            self.wal.open()
+
+    def sync(self):
+        pass
+
+    def append(self, records):
+        # Caller holds state_lock. Returns each record's apply_record() result,
+        # or the exception for a record that was rejected. Records are checked
+        # and applied first and only the ones that applied are logged, so a bad
+        # record never reaches the WAL.
+        results, logged = [], []
+        for rec in records:
+            try:
+                check_record(rec)
+                results.append(apply_record(rec))
+            except Exception as e:
+                app.logger.warning("state: rejected record %.200r: %s", rec, e)
+                results.append(e)
+                continue
+            logged.append(rec)
+        if self.wal is not None and logged:
+            self.wal.write(logged)
+        self.position += len(logged)
+        return results
+
+    def wait_durable(self, position):
+        if self.wal is not None:
+            self.wal.wait_durable(position)
+
+    def begin_checkpoint(self):
+        # Caller holds state_lock. The snapshot covers exactly the sealed segments.
+        if self.wal is not None:
+            self.wal.rotate()
+
+    def end_checkpoint(self, position):
+        if self.wal is not None:
+            self.wal.truncate_through(position)
+
+    def seed(self, records):
+        if self.position == 0:
+            self.append(records)
+
+class SqliteBackend:
+    def __init__(self, path, poll_interval):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.conn = None
+        self.pid = None
+        self.poller_pid = None
+        self.position = 0    # id of the last log row applied to this process's replica
+
+    def _connect(self):
+        # One connection per process, guarded by state_lock. A forked worker
+        # inherits the replica and its cursor but opens its own connection.
+        if self.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS log (id INTEGER PRIMARY KEY AUTOINCREMENT, body TEXT NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self.conn, self.pid = conn, os.getpid()
+        return self.conn
+
+    def _poll(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                with state_lock:
+                    self.sync()
+            except Exception:
+                # A locked or unreachable database; try again next tick.
+                app.logger.exception("state: sqlite poll failed")
+
+    def created(self):
+        # The first process to open the database fixes the genesis timestamp.
+        conn = self._connect()
+        conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('created', ?)", (repr(time.time()),))
+        return float(conn.execute("SELECT value FROM meta WHERE key = 'created'").fetchone()[0])
+
+    def open(self, position):
+        # Caller holds state_lock. Catches up from a restored snapshot.
+        self.position = position
+        self.sync()
+
+    def sync(self, upto=None):
+        # Caller holds state_lock. Replays rows committed by any process since the last sync.
+        conn = self._connect()
+        if upto is None:
+            rows = conn.execute("SELECT id, body FROM log WHERE id > ? ORDER BY id", (self.position,))
+        else:
+            rows = conn.execute("SELECT id, body FROM log WHERE id > ? AND id <= ? ORDER BY id", (self.position, upto))
+        for row_id, body in rows:
+            # A bad row is skipped by every replica alike, and position moves past it.
+            try:
+                rec = json.loads(body)
+            except ValueError as e:
+                app.logger.error("state: skipped unreadable log row %d: %s", row_id, e)
+            else:
+                apply_or_skip(rec, f"log row {row_id}")
+            self.position = row_id
+        # Started on first sync in each process, after the replica is bootstrapped.
+        if self.poll_interval > 0 and self.poller_pid != os.getpid():
+            self.poller_pid = os.getpid()
+            threading.Thread(target=self._poll, daemon=True).start()
+
+    def _insert(self, records, only_if_empty=False):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if only_if_empty and conn.execute("SELECT 1 FROM log LIMIT 1").fetchone():
+                ids = []
+            else:
+                ids = [conn.execute("INSERT INTO log (body) VALUES (?)", (json.dumps(rec),)).lastrowid for rec in records]
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return ids
+
+    def append(self, records):
+        # Caller holds state_lock. Rows from one transaction get consecutive ids,
+        # so after catching up to just before them we apply our own records
+        # directly instead of reading them back. Records that fail
+        # check_record() are never inserted; their result is the exception.
+        results, logged = [None] * len(records), []
+        for k, rec in enumerate(records):
+            try:
+                check_record(rec)
+            except ValueError as e:
+                app.logger.warning("state: rejected record %.200r: %s", rec, e)
+                results[k] = e
+            else:
+                logged.append(k)
+        if not logged:
+            return results
+        ids = self._insert([records[k] for k in logged])
+        self.sync(upto=ids[0] - 1)
+        for k, row_id in zip(logged, ids):
+            results[k] = apply_or_skip(records[k], f"log row {row_id}")
+        self.position = ids[-1]
+        return results
+
+    def wait_durable(self, position):
+        # COMMIT already made the rows durable.
+        pass
+
+    def begin_checkpoint(self):
+        pass
+
+    def end_checkpoint(self, position):
+        pass
+
+    def seed(self, records):
+        # Only the first process to start against an empty log writes the seed.
+        self._insert(records, only_if_empty=True)
+        self.sync()
+
+def make_backend(kind):
+    if kind == "memory":
+        return MemoryBackend(WriteAheadLog(DATA_DIR, WAL_COMMIT_DELAY) if DATA_DIR else None)
+    if kind == "sqlite":
+        return SqliteBackend(STATE_PATH, STATE_POLL_INTERVAL)
+    raise ValueError(f"unknown KIOTA_STATE_BACKEND {kind!r}")
+
+def commit(records):
+    # Appends records, waits until the backend has made them durable and
+    # returns each record's apply_record() result, or the exception for a
+    # record that was rejected. Must not be called with state_lock held, or the
+    # wait would stall every other request.
+    with state_lock:
+        results = state_backend.append(records)
+        position = state_backend.position
+    state_backend.wait_durable(position)
+    return results
+
+def dummy_records():
+    # Pre-fill with dummy data for visual check
+    curr = datetime.datetime.now()
+    records = []
+    for i in range(50):
+        t = curr - datetime.timedelta(seconds=(50-i)*2)
+        rand = random.random()
+        if rand < 0.7:
+            status = "Natural"; probs = [0.9, 0.05, 0.05]
+        elif rand < 0.85:
+            status = "Unnatural"; probs = [0.1, 0.8, 0.1]
+        else:
+            status = "Human Sound"; probs = [0.1, 0.1, 0.8]
+        records.append({"k": "event", "node": random.randint(0, 14), "ts": t.timestamp(), "status": status, "probs": probs, "fire": False})
+    return records
+
+if DATA_DIR:
+    os.makedirs(DATA_DIR, exist_ok=True)
+state_backend = make_backend(STATE_BACKEND)
+snapshotter = Snapshotter(SnapshotStore(DATA_DIR), SNAPSHOT_EVERY, SNAPSHOT_INTERVAL) if DATA_DIR else None
+community_ledger = Blockchain(genesis_ts=state_backend.created())
+ledger_checkpoints = LedgerCheckpoints(os.environ.get("KIOTA_LEDGER_KEY"),
+                                       os.path.join(DATA_DIR, "ledger_checkpoint.json") if DATA_DIR else None)
+
+with state_lock:
+    state_backend.open(snapshotter.store.restore_latest() if snapshotter else 0)
+    # Demo events are opt-in (KIOTA_DEMO_DATA=1) and only seed an empty log.
+    if DEMO_DATA:
+        state_backend.seed(dummy_records())
+if snapshotter:
+    snapshotter.start(state_backend.position)
+
+def seal_stale_batches():
+    # Closes a ledger batch that has sat open for LEDGER_BATCH_SECONDS. The
+    # seal goes through the log like any other change so replicas agree on it.
+    while True:
+        time.sleep(1.0)
+        with state_lock:
+            state_backend.sync()
+            pending = community_ledger.pending
+            stale = bool(pending) and time.time() - pending[0]["ts"] >= LEDGER_BATCH_SECONDS
+        if stale:
+            commit([{"k": "seal", "ts": time.time()}])
+
+if LEDGER_BATCH_SIZE > 1:
+    threading.Thread(target=seal_stale_batches, daemon=True).start()
+
+# --- INGESTION QUEUE ---
+# /alert, /alerts/batch and USSD reports are validated and resolved to a node in the request
+# thread, then queued; an applier thread drains the queue in batches through
+# commit(), so a burst of detections takes state_lock once per batch instead of
+# once per alert and readers are not starved. Fire alerts and community reports
+# go in a priority lane that is always drained first. Each lane is bounded and a
+# full lane answers 429 with a Retry-After estimated from the drain rate.
+# Items are acknowledged (202) before they are durable, so a crash loses
+# whatever is still queued. KIOTA_INGEST_QUEUE_SIZE=0 applies synchronously.
+INGEST_QUEUE_SIZE = int(os.environ.get("KIOTA_INGEST_QUEUE_SIZE", 10000))
+INGEST_BATCH = int(os.environ.get("KIOTA_INGEST_BATCH", 512))
+INGEST_RATE_WINDOW = 10.0
+
+class IngestQueue:
+    def __init__(self, capacity, batch):
+        self.capacity = capacity
+        self.batch = batch
+        self.cond = threading.Condition()
+        self.lanes = {"priority": deque(), "routine": deque()}    # drained in this order
+        self.in_flight = 0
+        self.ticket = 0
+        self.accepted = self.applied = self.rejected = self.failed = 0
+        self.drained = deque()    # (time, count) per applied batch
+        self.pid = None
+
+    def put(self, record, priority=False):
+        # Returns (ticket, lane), or None if the lane is full.
+        lane = "priority" if priority else "routine"
+        with self.cond:
+            if self.pid != os.getpid():
+                # Threads do not survive fork; each worker runs its own applier.
+                self.pid = os.getpid()
+                threading.Thread(target=self._run, daemon=True).start()
+            if len(self.lanes[lane]) >= self.capacity:
+                self.rejected += 1
+                return None
+            self.lanes[lane].append(record)
+            self.ticket += 1
+            self.accepted += 1
+            self.cond.notify_all()
+            return self.ticket, lane
+
+    def _take(self):
+        with self.cond:
+            while not any(self.lanes.values()):
+                self.cond.wait()
+            records = []
+            for lane in self.lanes.values():
+                while lane and len(records) < self.batch:
+                    records.append(lane.popleft())
+            self.in_flight = len(records)
+            return records
+
+    def _run(self):
+        while True:
+            records = self._take()
+            # commit() rejects bad records one by one; it only raises when the
+            # backend itself failed, and then the whole batch is lost.
+            try:
+                failed = sum(isinstance(r, Exception) for r in commit(records))
+            except Exception:
+                app.logger.exception("ingest: dropped a batch of %d records", len(records))
+                failed = len(records)
+            applied = len(records) - failed
+            now = time.time()
+            with self.cond:
+                self.applied += applied
+                self.failed += failed
+                if applied:
+                    self.drained.append((now, applied))
+                while self.drained and self.drained[0][0] < now - INGEST_RATE_WINDOW:
+                    self.drained.popleft()
+                self.in_flight = 0
+                self.cond.notify_all()
+
+    def drain_rate(self):
+        # Records applied per second over the last INGEST_RATE_WINDOW seconds.
+        with self.cond:
+            cutoff = time.time() - INGEST_RATE_WINDOW
+            return sum(n for t, n in self.drained if t >= cutoff) / INGEST_RATE_WINDOW
+
+    def retry_after(self, priority=False):
+        rate = self.drain_rate()
+        with self.cond:
+            backlog = len(self.lanes["priority"]) + self.in_flight
+            if not priority:
+                backlog += len(self.lanes["routine"])
+        return max(1, min(60, math.ceil(backlog / rate))) if rate else 1
+
+    def join(self, timeout=None):
+        # Waits until everything queued so far has been applied.
+        with self.cond:
+            return self.cond.wait_for(lambda: not self.in_flight and not any(self.lanes.values()), timeout)
+
+    def stats(self):
+        rate = self.drain_rate()
+        with self.cond:
+            return {
+                "capacity": self.capacity,
+                "depth": { name: len(lane) for name, lane in self.lanes.items() },
+                "in_flight": self.in_flight,
+                "accepted": self.accepted,
+                "applied": self.applied,
+                "rejected": self.rejected,
+                "failed": self.failed,
+                "drain_rate": rate,
+            }
+
+ingest_queue = IngestQueue(INGEST_QUEUE_SIZE, INGEST_BATCH) if INGEST_QUEUE_SIZE > 0 else None
 
 # --- USSD ROUTE ---
+# Gateways retry on timeout and expect an answer within a few seconds, so menus
+# and lookups are built once, phone hashes are memoised, and a submit is
+# remembered per (sessionId, text) for USSD_REPLY_TTL seconds: a retry gets the
+# original reply back instead of filing the report twice. The cache is per
+# process, so with several workers a retry routed elsewhere is not caught.
+# Each anonymised reporter may file USSD_BURST reports at once, refilled at
+# USSD_RATE_PER_HOUR.
+USSD_REPLY_CACHE = int(os.environ.get("KIOTA_USSD_REPLY_CACHE", 10000))
+USSD_REPLY_TTL = float(os.environ.get("KIOTA_USSD_REPLY_TTL", 300))
+USSD_REPLY_WAIT = 5.0
+USSD_RATE_PER_HOUR = float(os.environ.get("KIOTA_USSD_RATE_PER_HOUR", 10))
+USSD_BURST = float(os.environ.get("KIOTA_USSD_BURST", 3))
+
+USSD_MAIN_MENU = "CON BUNDI Reporter \n1. Illegal Logging \n2. Charcoal Burning \n3. Encroachment"
+USSD_LOCATION_MENU = "CON Select Location Code (0-14) \n 0.Buyangu Hill \n 1.Kisere Fragment \n 2.Isiukhu River \n 3.Salazar Circuit \n 								 	4.Isecheno Station \n 5.Lirhanda Hill \n 6.Yala River Border \n 7.Kibiri Block \n 8.Malava Edge \n 9.Ikuywa River East \n 10.Pump House Sector \n 11.Kaimosi Border \n 12.Mukumu West Gate \n 13.Cheenya Edge \n 14.Colobus Trail Inner"
+USSD_BUSY = "END Service busy. Try again shortly."
+USSD_ISSUES = {"1": "Logging", "2": "Charcoal", "3": "Encroachment"}
+USSD_LOCATIONS = {n["id"]: n["name"] for n in NODE_LOCATIONS if 0 <= n["id"] <= 14}
+
+@lru_cache(maxsize=65536)
+def anonymise(phone):
+    return hashlib.sha256(phone.encode()).hexdigest()[:8]
+
+class ReplyCache:
+    # LRU of replies with a TTL. A request that arrives while the same key is
+    # still being answered waits for that answer instead of redoing the work.
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.items = OrderedDict()    # key -> (expires, done Event, [reply])
+
+    def _forget(self, key, entry):
+        with self.lock:
+            if self.items.get(key) is entry:
+                del self.items[key]
+
+    def get_or_compute(self, key, compute, busy):
+        # compute() returns (reply, keep); replies with keep=False are not
+        # remembered. A request that gives up waiting on the original gets
+        # `busy` rather than running compute() a second time.
+        now = time.monotonic()
+        with self.lock:
+            entry = self.items.get(key)
+            owner = entry is None or entry[0] <= now
+            if owner:
+                entry = self.items[key] = (now + self.ttl, threading.Event(), [])
+                while len(self.items) > self.maxsize:
+                    self.items.popitem(last=False)
+            self.items.move_to_end(key)
+        _, done, reply = entry
+        if not owner:
+            if not done.wait(USSD_REPLY_WAIT):
+                return busy
+            if reply:
+                return reply[0]
+            return compute()[0]
+        try:
+            value, keep = compute()
+        except BaseException:
+            self._forget(key, entry)
+            done.set()
+            raise
+        if keep:
+            reply.append(value)
+        else:
+            self._forget(key, entry)
+        done.set()
+        return value
+
+class RateLimiter:
+    # Token bucket per key; the least recently seen keys are dropped past maxsize.
+    def __init__(self, per_hour, burst, maxsize=100000):
+        self.rate = per_hour / 3600.0
+        self.burst = burst
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()    # key -> [tokens, last refill]
+
+    def allow(self, key):
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [self.burst, now]
+                while len(self.buckets) > self.maxsize:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return True
+            return False
+
+ussd_replies = ReplyCache(USSD_REPLY_CACHE, USSD_REPLY_TTL)
+ussd_limiter = RateLimiter(USSD_RATE_PER_HOUR, USSD_BURST)
+
+def ussd_submit(inputs, phone):
+    # Returns (reply, keep). A busy reply is not kept, so the gateway's retry files the report.
+    r_type = USSD_ISSUES.get(inputs[0], "General")
+    try:
+        n_id = int(inputs[1])
+    except ValueError:
+        return "END Error. Try again.", True
+    name = USSD_LOCATIONS.get(n_id)
+    if name is None:
+        return "END Invalid Location Code", True
+    anon_id = anonymise(phone)
+    if not ussd_limiter.allow(anon_id):
+        return "END Too many reports. Try again later.", True
+
+    ts = time.time()
+    ref = report_ref(n_id, ts, r_type, anon_id)
+    rec = {"k": "report", "node": n_id, "ts": ts, "issue": r_type, "reporter": anon_id, "ref": ref}
+    if ingest_queue is None:
+        if isinstance(commit([rec])[0], Exception):
+            return "END Error. Try again.", False
+    elif ingest_queue.put(rec, priority=True) is None:
+        return USSD_BUSY, False
+    return f"END Report Filed. \nID: {anon_id} \nRef: {ref} \nLocation: {name}", True
+
 @app.route('/ussd', methods=['POST'])
 def ussd_callback():
     text = request.values.get("text", "default")
     inputs = text.split('*') if text else []
     phone = request.values.get("phoneNumber", "000")
-    
+    session = request.values.get("sessionId")
+
     if text == "":
-        response = "CON BUNDI Reporter \n1. Illegal Logging \n2. Charcoal Burning \n3. Encroachment"
-    elif len(inputs) == 1:
-        response = "CON Select Location Code (0-14) \n 0.Buyangu Hill \n 1.Kisere Fragment \n 2.Isiukhu River \n 3.Salazar Circuit \n 								 	4.Isecheno Station \n 5.Lirhanda Hill \n 6.Yala River Border \n 7.Kibiri Block \n 8.Malava Edge \n 9.Ikuywa River East \n 10.Pump House Sector \n 11.Kaimosi Border \n 12.Mukumu West Gate \n 13.Cheenya Edge \n 14.Colobus Trail Inner"
-    elif len(inputs) == 2:
-        try:
-            r_type = {"1":"Logging", "2":"Charcoal", "3":"Encroachment"}.get(inputs[0], "General")
-            n_id = int(inputs[1])
-            if 0 <= n_id <= 14:
-                target = NODE_LOCATIONS[n_id]
-                anon_id = hashlib.sha256(phone.encode()).hexdigest()[:8]
-                
-                # 1. Add to Blockchain
-                prev = community_ledger.get_previous_block()
-                data = {"issue": r_type, "loc": target['name'], "lat": target['lat'], "lng": target['lng'], "reporter": anon_id}
-                community_ledger.create_block(100, community_ledger.hash(prev), data)
-                
-                # 2. Register as Alert Event (Updates UI & History)
-                ts = datetime.datetime.now().strftime("%H:%M:%S")
-                status_msg = f"Community Report: {r_type}"
-                
-                node_states[n_id].update({ 
-                    "status": status_msg, 
-                    "probs": [0.0, 0.0, 0.0], 
-                    "fire": False, 
-                    "last_update": ts 
-                })
-                
-                event_history.append({ 
-                    "node_id": n_id, 
-                    "time": ts, 
-                    "status": "Community", 
-                    "probs": [0.0, 0.0, 0.0], 
-                    "fire": False 
-                })
-                
-                response = f"END Report Filed. \nID: {anon_id} \nLocation: {target['name']}"
-            else:
-                response = "END Invalid Location Code"
-        except:
-            response = "END Error. Try again."
-    else:
-        response = "END Invalid"
-    return response
+        return USSD_MAIN_MENU
+    if len(inputs) == 1:
+        return USSD_LOCATION_MENU
+    if len(inputs) != 2:
+        return "END Invalid"
+    try:
+        if not session:
+            return ussd_submit(inputs, phone)[0]
+        return ussd_replies.get_or_compute((session, text), lambda: ussd_submit(inputs, phone), USSD_BUSY)
+    except Exception:
+        app.logger.exception("ussd: submit failed")
+        return "END Error. Try again."
 
 HTML_TEMPLATE = """
 <!DOCTYPE html>
@@ -259,7 +2633,11 @@ HTML_TEMPLATE = """
 
             <div class="charts-row">
                 <div class="glass-panel">
-                    <div class="sub-label" style="margin-bottom: 15px;">Precision Timeline (Winning Class)</div>
+                    <div class="sub-label" style="margin-bottom: 15px; display: flex; justify-content: space-between;">Precision Timeline (Winning Class)
+                        <select class="reset-btn" onchange="setTimelineRange(this.value)">
+                            <option value="0">LIVE</option><option value="3600">1H</option><option value="86400">24H</option><option value="604800">7D</option><option value="2592000">30D</option>
+                        </select>
+                    </div>
                     <div style="height: 320px; position: relative;"><canvas id="lineChart"></canvas></div>
                 </div>
                 <div class="glass-panel">
@@ -274,6 +2652,12 @@ HTML_TEMPLATE = """
 <script>
     const colors = { Natural: '#10b981', Unnatural: '#f59e0b', Human: '#0ea5e9', Fire: '#ef4444', Community: '#a855f7' };
     var markers = {}, selectedNodeId = null, lineChart, doughChart, nodesData = {};
+    // Local replica of server state, kept current by merging /status?since=<seq> deltas.
+    var state = { seq: null, nodes: {}, history: [], ledger: [] };
+    // History of the focused node, fetched from /history and extended live.
+    // Only the timeline reads history now, so both lists are trimmed.
+    var focusHistory = [];
+    const HISTORY_KEEP = 500;
 
     const svgs = {
         Natural: `<svg viewBox="0 0 24 24" fill="${colors.Natural}" stroke="none"><path d="M17 8C8 10 5.9 16.17 3.82 21.34l1.89.66l.95-2.3c.48.17 1.05.23 1.63.09c-1.09-2.36-1.72-5.03-1.23-8.36c.39-2.67 2.17-4.89 4.54-5.42C13.32 5.62 15 6.5 17 8z"/></svg>`,
@@ -286,8 +2670,8 @@ HTML_TEMPLATE = """
     document.addEventListener("DOMContentLoaded", function() {
         initMap();
         initCharts();
-        setInterval(fetchData, 1000);
-        fetchData();
+        if (window.EventSource) connectStream();
+        else { setInterval(fetchData, 1000); fetchData(); }
     });
 
     function initMap() {
@@ -325,42 +2709,115 @@ HTML_TEMPLATE = """
         });
     }
 
-    async function fetchData() {
+    function mergeStatus(data) {
+        if (data.full) {
+            state.nodes = data.nodes; state.history = data.history.slice(-HISTORY_KEEP); state.ledger = data.ledger;
+        } else {
+            Object.assign(state.nodes, data.nodes);
+            data.history.forEach(addEvent);
+            state.ledger.push(...data.ledger);
+        }
+        state.seq = data.seq;
+    }
+
+    function trim(list) {
+        if (list.length > 2 * HISTORY_KEEP) list.splice(0, list.length - HISTORY_KEEP);
+    }
+
+    // A run that has absorbed more samples replaces its earlier copy in place.
+    function upsert(list, h) {
+        if (h.count > 1) {
+            for (let k = list.length - 1; k >= 0; k--) {
+                if (list[k].seq === h.seq) { list[k] = h; return; }
+                if (list[k].seq < h.seq) break;
+            }
+        }
+        list.push(h); trim(list);
+    }
+
+    function addEvent(h) {
+        upsert(state.history, h);
+        if (selectedNodeId !== null && h.node_id === selectedNodeId) upsert(focusHistory, h);
+    }
+
+    async function loadFocusHistory(id) {
+        focusHistory = [];
         try {
-            const res = await fetch('/status');
+            const res = await fetch('/history?node_id=' + id + '&limit=' + HISTORY_KEEP);
             const data = await res.json();
-            nodesData = data.nodes;
-            updateUI(data.nodes);
-            updateCharts(data.history);
-            calculateHotspot(data.history);
+            if (selectedNodeId !== id) return;
+            const seen = Math.max(0, ...data.events.map(h => h.seq_last || h.seq));
+            const live = focusHistory.filter(h => (h.seq_last || h.seq) > seen);
+            focusHistory = data.events;
+            live.forEach(h => upsert(focusHistory, h));
+            render();
         } catch (e) { console.error(e); }
     }
 
-    function calculateHotspot(history) {
-        let stats = {};
-        history.forEach(h => {
-            if (h.status === 'Natural' || h.status === 'Community') return;
-            let nid = h.node_id;
-            if (!stats[nid]) stats[nid] = { count: 0, sum: 0 };
-            let prob = (h.status === 'Unnatural') ? h.probs[1] : h.probs[2];
-            stats[nid].count++;
-            stats[nid].sum += prob;
-        });
+    // Counts and the hotspot come from /analytics, refreshed at most once a second while events arrive.
+    var analyticsTimer = null;
+    function scheduleAnalytics() {
+        if (analyticsTimer) return;
+        analyticsTimer = setTimeout(async () => {
+            analyticsTimer = null;
+            try {
+                const res = await fetch(selectedNodeId !== null ? '/analytics?node_id=' + selectedNodeId : '/analytics');
+                const data = await res.json();
+                updateCounts(data);
+                calculateHotspot(data);
+            } catch (e) { console.error(e); }
+        }, 1000);
+    }
 
-        let maxScore = -1;
-        let bestNodeId = null;
-        for (const [nid, data] of Object.entries(stats)) {
-            if (data.count === 0) continue;
-            let score = data.count * (data.sum / data.count);
-            if (score > maxScore) { maxScore = score; bestNodeId = nid; }
-        }
+    function render() {
+        nodesData = state.nodes;
+        updateUI(state.nodes);
+        updateCharts(state.history);
+        scheduleAnalytics();
+    }
+
+    // Bursts of pushed events are folded into at most one redraw per frame.
+    var renderPending = false;
+    function scheduleRender() {
+        if (renderPending) return;
+        renderPending = true;
+        requestAnimationFrame(() => { renderPending = false; render(); });
+    }
+
+    function connectStream() {
+        let source = new EventSource(state.seq === null ? '/stream' : '/stream?since=' + state.seq);
+        const apply = (fn) => (e) => {
+            const item = JSON.parse(e.data);
+            const seq = item.seq_last || item.seq;
+            if (seq <= state.seq) return;
+            fn(item);
+            state.seq = seq;
+            scheduleRender();
+        };
+        source.addEventListener('sync', (e) => { mergeStatus(JSON.parse(e.data)); scheduleRender(); });
+        source.addEventListener('node', apply(n => { state.nodes[n.id] = n; }));
+        source.addEventListener('event', apply(addEvent));
+        source.addEventListener('block', apply(b => { state.ledger.push(b); }));
+        // We fell too far behind and the server dropped us; reconnect from a full dump.
+        source.addEventListener('resync', () => { source.close(); state.seq = null; connectStream(); });
+    }
+
+    async function fetchData() {
+        try {
+            const res = await fetch(state.seq === null ? '/status' : '/status?since=' + state.seq);
+            mergeStatus(await res.json());
+            render();
+        } catch (e) { console.error(e); }
+    }
 
+    function calculateHotspot(data) {
         const hotspotEl = document.getElementById('stat-hotspot');
         const scoreEl = document.getElementById('stat-hotspot-score');
-        if (bestNodeId !== null && nodesData[bestNodeId]) {
-            hotspotEl.innerText = nodesData[bestNodeId].name;
+        const hot = data.hotspot;
+        if (hot && nodesData[hot.node_id]) {
+            hotspotEl.innerText = nodesData[hot.node_id].name;
             hotspotEl.style.color = colors.Unnatural;
-            scoreEl.innerText = `Threat Score: ${maxScore.toFixed(2)}`;
+            scoreEl.innerText = `Threat Score: ${hot.score.toFixed(2)}`;
         } else {
             hotspotEl.innerText = "None";
             hotspotEl.style.color = "#fff";
@@ -368,6 +2825,15 @@ HTML_TEMPLATE = """
         }
     }
 
+    function updateCounts(data) {
+        if(!doughChart) return;
+        const scope = (selectedNodeId !== null && data.node) ? data.node : data;
+        const c = scope.counts;
+        document.getElementById('stat-events').innerText = scope.events;
+        doughChart.data.datasets[0].data = [c.Natural, c.Unnatural, c.Human, c.Fire, c.Community];
+        doughChart.update('none');
+    }
+
     function updateUI(nodes) {
         const container = document.getElementById('node-list-container');
         let html = '';
@@ -385,7 +2851,7 @@ HTML_TEMPLATE = """
             
             html += `<div class="node-card ${cls} ${sel}" onclick="window.setFocus(${n.id}, ${n.lat}, ${n.lng})">
                 <div class="card-top"><span>${n.name}</span><span>${statusTxt}</span></div>
-                <div class="card-btm">Last Update: ${n.last_update}</div>
+                <div class="card-btm">Last Update: ${n.last_update}${n.at_risk && !n.fire ? ` · ⚠ AT RISK: fire ${Math.round(n.at_risk.distance_m)}m away` : ''}</div>
             </div>`;
 
             if(map) {
@@ -405,20 +2871,7 @@ HTML_TEMPLATE = """
 
     function updateCharts(history) {
         if(!lineChart || !doughChart) return;
-        const relevant = selectedNodeId !== null ? history.filter(h => h.node_id === selectedNodeId) : history;
-        
-        let c = { Natural:0, Unnatural:0, Human:0, Fire:0, Community:0 };
-        relevant.forEach(h => { 
-            if(h.fire) c.Fire++; 
-            else if(h.status === 'Natural') c.Natural++;
-            else if(h.status === 'Unnatural') c.Unnatural++;
-            else if(h.status === 'Human Sound') c.Human++;
-            else if(h.status === 'Community') c.Community++;
-        });
-        
-        document.getElementById('stat-events').innerText = relevant.length;
-        doughChart.data.datasets[0].data = [c.Natural, c.Unnatural, c.Human, c.Fire, c.Community];
-        doughChart.update('none');
+        const relevant = selectedNodeId !== null ? focusHistory : history;
 
         const recent = relevant.slice(-60);
         const last = recent.length ? recent[recent.length-1] : null;
@@ -437,6 +2890,7 @@ HTML_TEMPLATE = """
             threatEl.style.color = color;
         }
 
+        if (timelineRange) return;
         lineChart.data.labels = recent.map(h => h.time);
         lineChart.data.datasets[0].data = recent.map(h => h.status === 'Natural' ? h.probs[0] : null);
         lineChart.data.datasets[1].data = recent.map(h => h.status === 'Unnatural' ? h.probs[1] : null);
@@ -446,17 +2900,52 @@ HTML_TEMPLATE = """
         lineChart.update('none');
     }
 
+    // Past ranges come downsampled from /timeseries and refresh every 30s.
+    var timelineRange = 0, rangeTimer = null;
+    window.setTimelineRange = function(seconds) {
+        timelineRange = +seconds;
+        loadRange();
+    }
+
+    async function loadRange() {
+        clearTimeout(rangeTimer);
+        if (!timelineRange) { render(); return; }
+        const to = Date.now() / 1000, want = [timelineRange, selectedNodeId];
+        let url = '/timeseries?from=' + (to - timelineRange) + '&to=' + to + '&points=200';
+        if (selectedNodeId !== null) url += '&node_id=' + selectedNodeId;
+        try {
+            const data = await (await fetch(url)).json();
+            if (want[0] === timelineRange && want[1] === selectedNodeId) drawRange(data.series);
+        } catch (e) { console.error(e); }
+        rangeTimer = setTimeout(loadRange, 30000);
+    }
+
+    function drawRange(series) {
+        if(!lineChart) return;
+        const names = ['Natural', 'Unnatural', 'Human', 'Community'];
+        const xs = [...new Set(names.flatMap(n => series[n].map(p => p[0])))].sort((a, b) => a - b);
+        lineChart.data.labels = xs.map(x => new Date(x * 1000).toLocaleString());
+        names.forEach((n, k) => {
+            const means = new Map(series[n].map(p => [p[0], p[1]]));
+            lineChart.data.datasets[k].data = xs.map(x => means.has(x) ? means.get(x) : null);
+        });
+        lineChart.update('none');
+    }
+
     window.setFocus = function(id, lat, lng) {
         selectedNodeId = id;
         if(lat && lng && map) map.setView([lat, lng], 16);
         document.getElementById('analytics-focus-label').innerText = "Target: " + (nodesData[id] ? nodesData[id].name : "Node "+id);
-        fetchData();
+        loadFocusHistory(id);
+        if (timelineRange) loadRange();
+        render();
     }
     window.resetFocus = function() {
         selectedNodeId = null;
         if(map) map.setView([0.2827, 34.8647], 12);
         document.getElementById('analytics-focus-label').innerText = "Target: Global";
-        fetchData();
+        if (timelineRange) loadRange();
+        render();
     }
     window.switchTab = function(tab, btn) {
         document.querySelectorAll('.nav-btn').forEach(b => b.classList.remove('active'));
@@ -470,24 +2959,528 @@ HTML_TEMPLATE = """
 </html>
 """
 
+dashboard_page = None
+
 @app.route('/')
 def index():
-    return render_template_string(HTML_TEMPLATE)
+    # The template has no per-request context, so it is rendered once.
+    global dashboard_page
+    if dashboard_page is None:
+        body = render_template_string(HTML_TEMPLATE).encode()
+        dashboard_page = (hashlib.sha256(body).hexdigest()[:16], body)
+    tag, body = dashboard_page
+    return versioned_response(tag, body, 'text/html', 'public, max-age=300')
+
+def status_payload(since=None, keep=None):
+    # Caller holds state_lock. With `keep`, history and ledger are cut to their
+    # newest `keep` entries and nodes are copied, so the result can be
+    # serialized after the lock is released (blocks and rows are never mutated).
+    # A cursor from before a restart can be ahead of us; fall back to a full dump.
+    full = since is None or since > state_seq
+    if full:
+        nodes = node_states
+        history = event_history.slice() if keep is None else event_history.last(keep)
+        ledger = community_ledger.chain
+    else:
+        nodes = { n_id: n for n_id, n in node_states.items() if n["seq"] > since }
+        history = event_history.since(since)
+        ledger = community_ledger.chain[bisect_right(community_ledger.chain, since, key=lambda b: b["seq"]):]
+    if keep is None:
+        ledger = ledger[:]
+    else:
+        nodes = { n_id: dict(n) for n_id, n in nodes.items() }
+        history, ledger = history[-keep:] if keep else [], ledger[-keep:] if keep else []
+    return { "seq": state_seq, "full": full, "nodes": nodes, "history": history, "ledger": ledger }
 
 @app.route('/status', methods=['GET'])
 def get_status():
-    return jsonify({ "nodes": node_states, "history": list(event_history), "ledger": community_ledger.chain })
+    since = request.args.get('since', type=int)
+    fmt = pick_format()
+    if fmt is None:
+        return jsonify({ "error": "msgpack is not installed on this server" }), 406
+    with state_lock:
+        state_backend.sync()
+        # state_seq moves on every change, so with the genesis hash (which
+        # differs between unrelated ledgers) it versions the whole state.
+        cursor = since if since is not None and since <= state_seq else "full"
+        tag = f"{community_ledger.hashes[0][:12]}-{state_seq}-{cursor}-{fmt}"
+        body = None
+        if not request.if_none_match.contains(tag):
+            body = body_cache.get((tag, None))
+            if body is None:
+                body = serialize(status_payload(since), fmt)
+                body_cache.put((tag, None), body)
+    mimetype = 'application/msgpack' if fmt == 'msgpack' else 'application/json'
+    return versioned_response(tag, body, mimetype, 'no-cache')
+
+@app.route('/history', methods=['GET'])
+def get_history():
+    node_id = request.args.get('node_id', type=int)
+    t_from = request.args.get('from', type=float)
+    t_to = request.args.get('to', type=float)
+    limit = min(request.args.get('limit', HISTORY_QUERY_LIMIT, type=int), HISTORY_CAPACITY)
+    with state_lock:
+        state_backend.sync()
+        events, total = event_history.query(node_id, t_from, t_to, max(limit, 0))
+    return jsonify({ "node_id": node_id, "from": t_from, "to": t_to, "total": total, "events": events })
+
+def raw_series(node_id, t_from, t_to):
+    # Caller holds state_lock. Event-store rows in the /timeseries point shape.
+    series = [[] for _ in range(N_CLASSES)]
+    for e in event_history.query(node_id, t_from, t_to)[0]:
+        cls, value = series_value(e["status"], e["probs"], e["fire"])
+        if cls is None:
+            continue
+        lo = hi = value
+        if cls < 3 and "count" in e:
+            lo, hi = e["probs_min"][cls], e["probs_max"][cls]
+        series[cls].append([e["ts"], value, lo, hi, e.get("count", 1)])
+    return series
+
+def pick_tier(node_id, t_from, t_to, now):
+    # Caller holds state_lock. The finest tier that still covers t_from without
+    # reading more than TIMESERIES_RAW_LIMIT rows or TIMESERIES_SCAN_LIMIT buckets.
+    store = event_history
+    evicted = len(store) == store.capacity and store.ts[store.first_row % store.capacity] > t_from
+    if not evicted and store.query(node_id, t_from, t_to, 0)[1] <= TIMESERIES_RAW_LIMIT:
+        return "raw"
+    for tier, (width, fleet_retention, node_retention) in TIMESERIES_TIERS.items():
+        retention = fleet_retention if node_id is None else node_retention
+        if t_from >= now - retention and (t_to - t_from) / width <= TIMESERIES_SCAN_LIMIT:
+            return tier
+    return tier    # older than every retention: the coarsest tier has what is left
+
+@app.route('/timeseries', methods=['GET'])
+def get_timeseries():
+    node_id = request.args.get('node_id', type=int)
+    now = time.time()
+    t_to = request.args.get('to', now, type=float)
+    t_from = request.args.get('from', t_to - 3600, type=float)
+    points = min(max(request.args.get('points', 300, type=int), 3), TIMESERIES_MAX_POINTS)
+    if t_from >= t_to:
+        return jsonify({ "error": "'from' must be before 'to'" }), 400
+    with state_lock:
+        state_backend.sync()
+        tier = pick_tier(node_id, t_from, t_to, now)
+        series = raw_series(node_id, t_from, t_to) if tier == "raw" else timeseries.points(tier, node_id, t_from, t_to)
+    # Each point is [ts, mean, min, max, count]; a raw point is one history row.
+    return jsonify({ "node_id": node_id, "from": t_from, "to": t_to, "tier": tier,
+                     "series": { name: lttb(s, points) for name, s in zip(ANALYTICS_CLASSES, series) } })
+
+def find_incidents(t_from, t_to, radius_m, gap):
+    # Caller holds state_lock. Threat rows (Unnatural, Human Sound or fire) of
+    # one node no more than `gap` seconds apart form a burst; bursts on nodes
+    # within radius_m of each other whose spans come within `gap` are joined
+    # into one incident.
+    store = event_history
+    rows = range(store.first_row, store.next_row)
+    key = lambda r: store.ts[r % store.capacity]
+    slots = np.arange(store.first_row + bisect_left(rows, t_from, key=key),
+                      store.first_row + bisect_left(rows, t_to, key=key)) % store.capacity
+    column = lambda name, dtype: np.frombuffer(getattr(store, name), dtype=dtype)[slots]
+    status, fire = column("status", np.uint8), column("fire", np.uint8)
+    unnatural, human = store.status_codes.get("Unnatural", -1), store.status_codes.get("Human Sound", -1)
+    threat = (status == unnatural) | (status == human) | (fire == 1)
+    if not threat.any():
+        return []
+    slots, status, fire = slots[threat], status[threat], fire[threat]
+    node = column("node_id", np.int32)
+    first, last = column("ts", np.float64), column("ts_last", np.float64)
+    samples = column("samples", np.uint32).astype(np.int64)
+    peak = np.where(fire == 1, 1.0, np.where(status == unnatural, column("hi1", np.float64), column("hi2", np.float64)))
+
+    # Bursts: rows sorted by node then time, split on a node change or a gap.
+    order = np.lexsort((first, node))
+    node, first, last, samples, peak, status, fire = (a[order] for a in (node, first, last, samples, peak, status, fire))
+    new = np.ones(len(node), dtype=bool)
+    new[1:] = (node[1:] != node[:-1]) | (first[1:] - last[:-1] > gap)
+    starts = np.flatnonzero(new)
+    burst = np.cumsum(new) - 1
+    b_node, b_first = node[starts], first[starts]
+    b_last = np.maximum.reduceat(last, starts)
+
+    # Join bursts within radius_m whose spans come within `gap`. In order of
+    # first sample, each burst is only compared with the later ones that start
+    # before it ends, so memory stays linear in the number of bursts.
+    by_first = np.argsort(b_first, kind='stable')
+    slot = proximity.slots_of(b_node[by_first].tolist())
+    ends = np.searchsorted(b_first[by_first], b_last[by_first] + gap, side='right')
+    by_first = by_first.tolist()
+    parent = list(range(len(starts)))
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    for a, end in enumerate(ends.tolist()):
+        if end > a + 1:
+            for b in (np.flatnonzero(proximity.dist[slot[a], slot[a + 1:end]] <= radius_m) + a + 1).tolist():
+                parent[root(by_first[b])] = root(by_first[a])
+    group = np.array([root(b) for b in range(len(starts))])[burst]
+
+    incidents = []
+    for incident in np.unique(group).tolist():
+        members = group == incident
+        nodes = sorted(set(node[members].tolist()))
+        classes = {}
+        for code, is_fire, n in zip(status[members].tolist(), fire[members].tolist(), samples[members].tolist()):
+            name = "Fire" if is_fire else store.status_names[code]
+            classes[name] = classes.get(name, 0) + n
+        incidents.append({
+            "nodes": nodes,
+            "samples": int(samples[members].sum()),
+            "first_ts": float(first[members].min()),
+            "last_ts": float(last[members].max()),
+            "classes": classes,
+            "fire": bool(fire[members].any()),
+            "peak": float(peak[members].max()),
+            "lat": sum(node_states[n]["lat"] for n in nodes) / len(nodes),
+            "lng": sum(node_states[n]["lng"] for n in nodes) / len(nodes),
+        })
+    incidents.sort(key=lambda i: i["last_ts"], reverse=True)
+    return incidents
+
+@app.route('/incidents', methods=['GET'])
+def get_incidents():
+    window = request.args.get('window', INCIDENT_WINDOW, type=float)
+    radius_m = request.args.get('radius_m', INCIDENT_RADIUS_M, type=float)
+    gap = request.args.get('gap', INCIDENT_GAP, type=float)
+    t_from = time.time() - window
+    with state_lock:
+        state_backend.sync()
+        incidents = find_incidents(t_from, math.inf, radius_m, gap)
+    return jsonify({ "from": t_from, "radius_m": radius_m, "gap": gap, "incidents": incidents })
+
+@app.route('/nearby', methods=['GET'])
+def get_nearby():
+    # Nodes within radius_m and/or the k nearest, around node_id or lat/lng.
+    node_id = request.args.get('node_id', type=int)
+    lat, lng = request.args.get('lat', type=float), request.args.get('lng', type=float)
+    radius_m = request.args.get('radius_m', type=float)
+    k = request.args.get('k', None if radius_m is not None else 5, type=int)
+    with state_lock:
+        state_backend.sync()
+        if node_id is not None:
+            if node_id not in proximity.slots:
+                return jsonify({ "error": f"unknown node {node_id}" }), 404
+            ids, dists = proximity.select(proximity.row(node_id), radius_m, k, exclude=node_id)
+        elif lat is not None and lng is not None:
+            ids, dists = proximity.select(proximity.point_row(lat, lng), radius_m, k)
+        else:
+            return jsonify({ "error": "node_id or lat and lng are required" }), 400
+    return jsonify({ "nodes": [{ "node_id": i, "distance_m": round(d, 1) } for i, d in zip(ids.tolist(), dists.tolist())] })
+
+@app.route('/analytics', methods=['GET'])
+def get_analytics():
+    window = request.args.get('window', 'all')
+    if window != 'all' and window not in ANALYTICS_WINDOWS:
+        return jsonify({ "error": f"unknown window {window!r}", "windows": ["all", *ANALYTICS_WINDOWS] }), 400
+    node_id = request.args.get('node_id', type=int)
+    with state_lock:
+        state_backend.sync()
+        result = analytics.summary(window, node_id)
+    result["window"] = window
+    return jsonify(result)
+
+@app.route('/ledger/proof/<report_id>', methods=['GET'])
+def ledger_proof(report_id):
+    # To verify: start from `leaf` = sha256(0x00 || report JSON with sorted keys);
+    # for each step hash sha256(0x01 || left || right) over the raw digests,
+    # placing the step's hash on its `side`; the result must equal
+    # `merkle_root`. That root is in `block_header`, and sha256 of the header
+    # JSON with sorted keys is `block_hash`, which the next block's
+    # previous_hash links to the chain.
+    with state_lock:
+        state_backend.sync()
+        proof = community_ledger.proof(report_id)
+        pending = proof is None and any(r["report_id"] == report_id for r in community_ledger.pending)
+    if pending:
+        return jsonify({ "report_id": report_id, "status": "pending" }), 202
+    if proof is None:
+        return jsonify({ "error": "unknown report_id" }), 404
+    return jsonify(proof)
+
+@app.route('/ledger/verify', methods=['GET', 'POST'])
+def ledger_verify():
+    # Verifies blocks added since the last signed checkpoint, or the whole chain
+    # with ?full=1 or when the checkpointed block no longer hashes the same.
+    full = request.args.get('full', '') not in ('', '0')
+    with ledger_checkpoints.lock:
+        with state_lock:
+            state_backend.sync()
+            height = len(community_ledger.chain)
+        start, note = 0, None
+        checkpoint = ledger_checkpoints.latest
+        if checkpoint and not full:
+            if checkpoint["height"] <= height and block_hash(community_ledger.chain[checkpoint["height"] - 1]) == checkpoint["hash"]:
+                start = checkpoint["height"]
+            else:
+                note = "checkpoint no longer matches the chain; verified from genesis"
+        began = time.perf_counter()
+        result = community_ledger.verify(start, height)
+        result.update(height=height, verified_from=start + 1,
+                      elapsed_ms=round((time.perf_counter() - began) * 1000, 3))
+        if result["ok"]:
+            result["checkpoint"] = ledger_checkpoints.record(height, result["last_hash"])
+        else:
+            ledger_checkpoints.clear()
+        if note:
+            result["note"] = note
+    return jsonify(result), 200 if result["ok"] else 409
+
+@app.route('/stream')
+def stream():
+    # EventSource resends the last id it saw on reconnect, so resume from there.
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = request.args.get('since', type=int)
+    with state_lock:
+        state_backend.sync()
+        # Subscribe and snapshot under the same lock so nothing falls between them.
+        sub = event_hub.subscribe()
+        payload, seq = status_payload(since, STREAM_SYNC_KEEP), state_seq
+    first = sse_frame("sync", payload, seq)
+
+    def generate():
+        try:
+            yield first
+            deadline = time.monotonic() + STREAM_MAX_SECONDS if STREAM_MAX_SECONDS > 0 else None
+            while deadline is None or time.monotonic() < deadline:
+                messages, dropped = sub.pop_all(STREAM_HEARTBEAT)
+                if dropped:
+                    yield sse_frame("resync", {})
+                    return
+                yield "".join(messages) if messages else ": keepalive\n\n"
+        finally:
+            event_hub.unsubscribe(sub)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={'X-Accel-Buffering': 'no'})
 
 @app.route('/alert', methods=['POST'])
 def receive_alert():
     d = request.json
-    t_id = next((n["id"] for n in node_states.values() if n["lat"] == d.get('lat') and n["lng"] == d.get('lng')), None)
-    if t_id is not None:
-        ts = datetime.datetime.now().strftime("%H:%M:%S")
-        node_states[t_id].update({ "status": d['class'], "probs": d['probs'], "fire": d['fire'], "last_update": ts })
-        event_history.append({ "node_id": t_id, "time": ts, "status": d['class'], "probs": d['probs'], "fire": d['fire'] })
+    try:
+        status, probs, fire = parse_alert(d)
+    except ValueError as e:
+        return str(e), 400
+    ts = time.time()
+    with state_lock:
+        state_backend.sync()
+        t_id = resolve_node(d)
+    if t_id is None:
+        return "404", 404
+    rec = {"k": "alert", "node": t_id, "ts": ts, "status": status, "probs": probs, "fire": fire}
+    if ingest_queue is None:
+        result = commit([rec])[0]
+        if isinstance(result, Exception):
+            return str(result), 400
         return "OK", 200
-    return "404", 404
+    queued = ingest_queue.put(rec, priority=fire)
+    if queued is None:
+        return jsonify({ "error": "ingest queue is full" }), 429, { "Retry-After": str(ingest_queue.retry_after(fire)) }
+    ticket, lane = queued
+    return jsonify({ "ticket": ticket, "lane": lane }), 202
+
+@app.route('/ingest', methods=['GET'])
+def ingest_stats():
+    if ingest_queue is None:
+        return jsonify({ "queue": None })
+    return jsonify(ingest_queue.stats())
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    with state_lock:
+        state_backend.sync()
+        gauges = [
+            ("history_rows", "gauge", "History rows held in the event store.", len(event_history)),
+            ("history_capacity", "gauge", "Event store capacity in rows.", event_history.capacity),
+            ("events_total", "counter", "Sensor samples and reports recorded.", analytics.summary()["events"]),
+            ("ledger_height", "gauge", "Blocks on the community ledger.", len(community_ledger.chain)),
+            ("ledger_pending_reports", "gauge", "Reports waiting for the next ledger batch.", len(community_ledger.pending)),
+            ("nodes", "gauge", "Registered sensor nodes.", len(node_states)),
+            ("state_seq", "gauge", "Current state sequence number.", state_seq),
+            ("ingest_events_per_second", "gauge", "Samples recorded per second over the last 5 minutes.",
+             analytics.summary("5m")["events"] / ANALYTICS_WINDOWS["5m"][0]),
+        ]
+    gauges += [
+        ("stream_subscribers", "gauge", "Open /stream connections.", len(event_hub.subscribers)),
+        ("body_cache_bytes", "gauge", "Bytes held by the response body cache.", body_cache.bytes),
+    ]
+    out = metrics.render()
+    for name, kind, text, value in gauges:
+        out += [f"# HELP kiota_{name} {text}", f"# TYPE kiota_{name} {kind}", f"kiota_{name} {value}"]
+    if ingest_queue is not None:
+        stats = ingest_queue.stats()
+        out += ["# HELP kiota_ingest_queue_depth Queued records by lane.", "# TYPE kiota_ingest_queue_depth gauge"]
+        out += [f'kiota_ingest_queue_depth{{lane="{lane}"}} {n}' for lane, n in stats["depth"].items()]
+        out += ["# HELP kiota_ingest_queue_drain_rate Records applied per second.", "# TYPE kiota_ingest_queue_drain_rate gauge",
+                f"kiota_ingest_queue_drain_rate {stats['drain_rate']}"]
+        for name in ("accepted", "applied", "rejected", "failed"):
+            out += [f"# TYPE kiota_ingest_{name}_total counter", f"kiota_ingest_{name}_total {stats[name]}"]
+    return Response("\n".join(out) + "\n", content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# --- BULK INGESTION ---
+# Gateways upload buffered detections as a JSON array or NDJSON. The body is
+# decoded as it is read, every item is validated first, and node lookups are
+# memoised per distinct location. Valid items then go through the ingestion
+# queue like single alerts, so they share its ordering, priority lane and
+# backpressure; items that find their lane full are reported back with a 429
+# once nothing was queued. Without the queue the batch is committed in one go.
+BATCH_MAX_ITEMS = int(os.environ.get("KIOTA_BATCH_MAX_ITEMS", 100000))
+BATCH_CHUNK = 64 * 1024
+
+def iter_batch_items(stream, ndjson):
+    # Yields each alert as a dict, or a ValueError for an NDJSON line that does
+    # not parse. A malformed JSON array raises instead, since it cannot resync.
+    # ndjson=None picks the format from the first non-blank character.
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    json_decoder = json.JSONDecoder()
+    buf, pos, eof = "", 0, False
+    # Array grammar position: "open" before '[', "first" right after it, "item"
+    # after a ',', "sep" after an item and "done" after the closing ']'.
+    expect = "open"
+    while True:
+        if ndjson is None and buf.strip():
+            ndjson = buf.lstrip()[0] != '['
+        if ndjson:
+            newline = buf.find("\n", pos)
+            if newline >= 0 or (eof and pos < len(buf)):
+                end = newline if newline >= 0 else len(buf)
+                line = buf[pos:end].strip()
+                pos = end + 1
+                if line:
+                    try:
+                        yield json.loads(line)
+                    except ValueError as e:
+                        yield ValueError(f"invalid JSON: {e}")
+                continue
+        elif ndjson is False:
+            while pos < len(buf) and buf[pos].isspace():
+                pos += 1
+            if pos < len(buf):
+                c = buf[pos]
+                if expect == "open":
+                    if c != '[':
+                        raise ValueError("body must be a JSON array")
+                    expect, pos = "first", pos + 1
+                    continue
+                if expect == "done":
+                    raise ValueError(f"unexpected data after JSON array at offset {pos}")
+                if expect == "sep":
+                    if c not in ',]':
+                        raise ValueError(f"expected ',' or ']' in JSON array at offset {pos}")
+                    expect, pos = "item" if c == ',' else "done", pos + 1
+                    continue
+                if c == ']' and expect == "first":
+                    expect, pos = "done", pos + 1
+                    continue
+                if c in ',]':
+                    raise ValueError(f"missing item in JSON array at offset {pos}")
+                try:
+                    item, end = json_decoder.raw_decode(buf, pos)
+                except ValueError:
+                    if eof:
+                        raise ValueError(f"malformed JSON array at offset {pos}")
+                    item, end = None, None
+                if end is not None:
+                    # A token running into the buffer edge may be cut short: a chunk
+                    # ending in "45000000000." decodes as an int. Read on first.
+                    tail = end
+                    while tail < len(buf) and not (buf[tail].isspace() or buf[tail] in ',]'):
+                        tail += 1
+                    if tail < len(buf) or eof:
+                        expect, pos = "sep", end
+                        yield item
+                        continue
+        if eof:
+            if ndjson is False and expect != "done":
+                raise ValueError("unterminated JSON array")
+            return
+        chunk = stream.read(BATCH_CHUNK)
+        eof = not chunk
+        buf = buf[pos:] + decoder.decode(chunk, final=eof)
+        pos = 0
+
+@app.route('/alerts/batch', methods=['POST'])
+def receive_alert_batch():
+    ndjson = True if request.mimetype in ('application/x-ndjson', 'application/ndjson', 'application/jsonl') else None
+    try:
+        items = []
+        for item in iter_batch_items(request.stream, ndjson):
+            if len(items) == BATCH_MAX_ITEMS:
+                return jsonify({ "error": f"batch exceeds {BATCH_MAX_ITEMS} items" }), 413
+            items.append(item)
+    except ValueError as e:
+        return jsonify({ "error": str(e) }), 400
+
+    results = [None] * len(items)
+    parsed = []
+    for i, item in enumerate(items):
+        try:
+            if isinstance(item, ValueError):
+                raise item
+            parsed.append((i, item, *parse_alert(item)))
+        except ValueError as e:
+            results[i] = { "index": i, "ok": False, "error": str(e) }
+
+    ts = time.time()
+    resolved = {}
+    records, owners = [], []
+    with state_lock:
+        state_backend.sync()
+        for i, d, status, probs, fire in parsed:
+            key = (d.get('node_id'), d.get('lat'), d.get('lng'))
+            try:
+                t_id = resolved[key]
+            except KeyError:
+                t_id = resolved[key] = resolve_node(d)
+            except TypeError:   # unhashable coordinates
+                t_id = None
+            if t_id is None:
+                results[i] = { "index": i, "ok": False, "error": "no node at this location" }
+                continue
+            records.append({"k": "alert", "node": t_id, "ts": ts, "status": status, "probs": probs, "fire": fire})
+            owners.append(i)
+    if ingest_queue is None:
+        for i, rec, seq in zip(owners, records, commit(records)):
+            if isinstance(seq, Exception):
+                results[i] = { "index": i, "ok": False, "error": str(seq) }
+            else:
+                results[i] = { "index": i, "ok": True, "node_id": rec["node"], "seq": seq }
+        accepted = sum(1 for r in results if r["ok"])
+        return jsonify({ "accepted": accepted, "rejected": len(results) - accepted, "results": results })
+
+    full = set()
+    for i, rec in zip(owners, records):
+        queued = ingest_queue.put(rec, priority=rec["fire"])
+        if queued is None:
+            full.add(rec["fire"])
+            results[i] = { "index": i, "ok": False, "error": "ingest queue is full" }
+        else:
+            results[i] = { "index": i, "ok": True, "node_id": rec["node"], "ticket": queued[0], "lane": queued[1] }
+    accepted = sum(1 for r in results if r["ok"])
+    body = jsonify({ "accepted": accepted, "rejected": len(results) - accepted, "results": results })
+    if full and not accepted:
+        return body, 429, { "Retry-After": str(ingest_queue.retry_after(True in full)) }
+    return body, 202 if accepted else 200
+
+@app.route('/nodes', methods=['POST'])
+def add_node():
+    d = request.json
+    try:
+        lat, lng = float(d['lat']), float(d['lng'])
+        node_id = d.get('id')
+        node_id = None if node_id is None else int(node_id)
+    except (KeyError, TypeError, ValueError):
+        return jsonify({ "error": "lat and lng are required" }), 400
+    if not valid_location(lat, lng):
+        return jsonify({ "error": "lat and lng must be finite and in range" }), 400
+    node_id = commit([{"k": "node", "lat": lat, "lng": lng, "name": d.get('name'), "id": node_id, "ts": time.time()}])[0]
+    if isinstance(node_id, Exception):
+        return jsonify({ "error": str(node_id) }), 400
+    with state_lock:
+        node = dict(node_states[node_id])
+    return jsonify(node), 201
 
 if __name__ == '__main__':
     app.run(port=5000, debug=True)
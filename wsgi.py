@@ -1,4 +1,8 @@
 from kiota import app
 
+# Module state is per process. To run more than one worker, point every worker
+# at one shared log, e.g.:
+#   KIOTA_STATE_BACKEND=sqlite KIOTA_STATE_PATH=/var/lib/kiota/state.db gunicorn -w 4 wsgi:app
+
 if __name__ == "__main__":
     app.run()